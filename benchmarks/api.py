@@ -0,0 +1,409 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Benchmarks of the webapp REST API
+
+A synthetic dataset is created in a temporary directory, and common
+requests are timed against the app, via the Flask test client and
+(optionally) via HTTP against a real server. Results are written as JSON,
+and can be compared with the results of an earlier run:
+
+    python benchmarks/api.py --files 1000 --output new.json
+    python benchmarks/api.py --files 1000 --compare old.json
+
+The exit code is non-zero if any benchmark got slower than the threshold.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import os.path as op
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+api_key = 'benchmark'
+
+
+def create_dataset(path, files=100, annexed=0.5, subdatasets=2, depth=1):
+    """Create a synthetic dataset
+
+    Parameters
+    ----------
+    path : str
+    files : int
+      Number of files, split between the 'git/' and 'annex/' directories.
+    annexed : float
+      Fraction of files that are annexed.
+    subdatasets : int
+      Number of subdatasets in each (sub)dataset down to `depth`.
+    depth : int
+      Nesting depth of subdatasets.
+
+    Returns
+    -------
+    Dataset
+    """
+    from datalad.api import create
+    ds = create(path, result_renderer=None)
+    n_annexed = int(round(files * annexed))
+    for subdir, n, to_git in (
+            ('git', files - n_annexed, True),
+            ('annex', n_annexed, False)):
+        if not n:
+            continue
+        os.makedirs(op.join(ds.path, subdir))
+        for i in range(n):
+            with open(op.join(ds.path, subdir, 'f{:05d}'.format(i)), 'w') as f:
+                f.write('content of {} file {}\n'.format(subdir, i))
+        ds.save(subdir, to_git=to_git, result_renderer=None)
+    with open(op.join(ds.path, 'records.json'), 'w') as f:
+        for i in range(1000):
+            f.write(json.dumps(dict(id=i, name='record {}'.format(i))) + '\n')
+    ds.save('records.json', to_git=True, result_renderer=None)
+
+    def _add_subdatasets(parent, level):
+        for i in range(subdatasets):
+            sub = parent.create('sub{}'.format(i), result_renderer=None)
+            if level < depth:
+                _add_subdatasets(sub, level + 1)
+                parent.save('sub{}'.format(i), result_renderer=None)
+    if depth:
+        _add_subdatasets(ds, 1)
+    ds.config.set(
+        'datalad.webapp.api-key', api_key, where='local', reload=True)
+    return ds
+
+
+class TestClient(object):
+    """Requests via the Flask test client"""
+    name = 'testclient'
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, url, data=None, headers=None):
+        rv = self._client.open(url, method=method, data=data, headers=headers)
+        assert rv.status_code < 400, (url, rv.status_code, rv.data)
+        return rv.data
+
+
+class HTTPClient(object):
+    """Requests via HTTP against a threaded werkzeug server"""
+    name = 'http'
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self._server = make_server('127.0.0.1', 0, app, threaded=True)
+        self._base = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def request(self, method, url, data=None, headers=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        rq = urllib.request.Request(
+            self._base + url, data=data, headers=headers or {},
+            method=method)
+        with urllib.request.urlopen(rq) as rv:
+            return rv.read()
+
+    def close(self):
+        self._server.shutdown()
+
+
+def get_cases():
+    """Return the benchmarked requests by name
+
+    Each case is a function that takes a client and an iteration number.
+    """
+    auth = {'Authorization': 'Bearer {}'.format(api_key)}
+    json_headers = dict(auth, **{'Content-Type': 'application/json'})
+
+    def _get(url):
+        return lambda c, i: c.request('GET', url, headers=auth)
+
+    def _clear_cache(c):
+        c.request('DELETE', '/api/v1/cache', headers=auth)
+
+    def subdatasets_uncached(c, i):
+        _clear_cache(c)
+        c.request('GET', '/api/v1/subdataset?recursive=yes', headers=auth)
+
+    def read_batch(c, i):
+        c.request(
+            'POST', '/api/v1/file',
+            data=json.dumps(dict(path='git/f000*')), headers=json_headers)
+
+    object_urls = {}
+
+    def read_object(c, i):
+        if c not in object_urls:
+            keys = json.loads(c.request(
+                'GET', '/api/v1/file?path=annex/f00000*&keys=yes',
+                headers=auth))['keys']
+            object_urls[c] = '/api/v1/object/' + keys['annex/f00000']
+        c.request('GET', object_urls[c], headers=auth)
+
+    def write(c, i):
+        c.request(
+            'PUT', '/api/v1/file/bench/write/f{:05d}'.format(i),
+            data=json.dumps(dict(content=str(i))), headers=json_headers)
+
+    def write_deferred(c, i):
+        c.request(
+            'PATCH', '/api/v1/file',
+            data=json.dumps(dict(
+                changes=[dict(
+                    path='bench/deferred/f{:05d}'.format(i),
+                    content=str(i))],
+                defer=True)),
+            headers=json_headers)
+
+    return dict([
+        ('list', _get('/api/v1/file')),
+        ('list_page', _get('/api/v1/file?path=git/*&limit=100')),
+        ('list_keys', _get('/api/v1/file?path=git/*&limit=100&keys=yes')),
+        ('read_git', _get('/api/v1/file/git/f00000')),
+        ('read_annex_raw', _get('/api/v1/file/annex/f00000?raw=yes')),
+        ('read_object', read_object),
+        ('read_json_stream',
+         _get('/api/v1/file/records.json?json=stream&offset=500&limit=100')),
+        ('read_batch', read_batch),
+        ('write', write),
+        ('write_deferred', write_deferred),
+        ('subdatasets', _get('/api/v1/subdataset?recursive=yes')),
+        ('subdatasets_uncached', subdatasets_uncached),
+    ])
+
+
+def get_content_checks(ds):
+    """Return benchmarks of content availability checks by name
+
+    Compares the local check done before reading a file with a call of
+    `get`, for content that is already present.
+    """
+    from datalad_webapp.content import has_local_content
+    # ensure bound dataset method
+    import datalad.distribution.get
+    path = op.join(ds.path, 'annex', 'f00000')
+    if not op.lexists(path):
+        return {}
+    return dict(
+        has_local_content=lambda i: has_local_content(path),
+        get_present=lambda i: ds.get(path, result_renderer=None),
+    )
+
+
+def get_overhead_checks(app):
+    """Return benchmarks of the per-request work of a resource by name
+
+    Times setting up a resource and parsing the request arguments, without
+    any request handling around it.
+    """
+    from datalad_webapp.resources.file import FileResource
+    kwargs = dict(app.extensions['datalad_webapp'], read_only=False)
+    url = '/api/v1/file/git/f00000?json=yes&raw=no'
+
+    def resource_init(i):
+        with app.test_request_context(url):
+            FileResource(**kwargs)
+
+    def resource_parse(i):
+        with app.test_request_context(url):
+            FileResource(**kwargs).rp.parse_args()
+
+    return dict(
+        resource_init=resource_init,
+        resource_parse=resource_parse,
+    )
+
+
+def measure(func, repeat, warmup=1):
+    """Call a function repeatedly and return timing statistics (seconds)"""
+    for i in range(warmup):
+        func(repeat + i)
+    times = []
+    t_total = time.perf_counter()
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - t0)
+    t_total = time.perf_counter() - t_total
+    times.sort()
+    return dict(
+        n=repeat,
+        min=times[0],
+        median=statistics.median(times),
+        mean=statistics.mean(times),
+        p95=times[min(len(times) - 1, int(len(times) * .95))],
+        max=times[-1],
+        throughput=repeat / t_total,
+    )
+
+
+def compare(results, baseline, threshold):
+    """Print the change of median times, and return regressed benchmarks"""
+    regressions = []
+    for group, cases in sorted(results['results'].items()):
+        for case, stats in sorted(cases.items()):
+            old = baseline.get('results', {}).get(group, {}).get(case)
+            if not old:
+                continue
+            ratio = stats['median'] / old['median']
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                regressions.append('{}/{}'.format(group, case))
+            print('{:<40} {:>10.2f}ms {:>10.2f}ms {:>6.2f}x{}'.format(
+                '{}/{}'.format(group, case),
+                old['median'] * 1000, stats['median'] * 1000, ratio, flag))
+    return regressions
+
+
+def get_versions():
+    import datalad
+    import flask
+    import datalad_webapp
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        datalad=datalad.__version__,
+        flask=flask.__version__,
+        datalad_webapp=getattr(datalad_webapp, '__version__', None),
+    )
+
+
+def run(args, path):
+    """Create a benchmark dataset at `path` and run all benchmarks"""
+    t0 = time.perf_counter()
+    ds = create_dataset(
+        path, files=args.files, annexed=args.annexed,
+        subdatasets=args.subdatasets, depth=args.depth)
+    print('Created dataset in {:.1f}s'.format(time.perf_counter() - t0),
+          file=sys.stderr)
+
+    from datalad.api import webapp
+    res = webapp(
+        dataset=ds.path, mode='dry-run', return_type='item-or-list',
+        result_renderer=None)
+    app = res['app']
+    results = dict(
+        params=dict(
+            files=args.files,
+            annexed=args.annexed,
+            subdatasets=args.subdatasets,
+            depth=args.depth,
+            repeat=args.repeat,
+        ),
+        versions=get_versions(),
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        startup_time=res['startup_time'],
+        results={},
+    )
+
+    def _selected(name):
+        return not args.select or name in args.select
+
+    def _measure(group, name, func):
+        stats = results['results'].setdefault(group, {})
+        stats[name] = measure(func, args.repeat)
+        print('{:<12} {:<24} median {:>8.2f}ms  {:>8.1f}/s'.format(
+            group, name, stats[name]['median'] * 1000,
+            stats[name]['throughput']), file=sys.stderr)
+
+    for name, func in get_content_checks(ds).items():
+        if _selected(name):
+            _measure('content', name, func)
+
+    for name, func in get_overhead_checks(app).items():
+        if _selected(name):
+            _measure('overhead', name, func)
+
+    clients = [TestClient]
+    if args.server:
+        clients.append(HTTPClient)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    for client_cls in clients:
+        client = client_cls(app)
+        for name, case in get_cases().items():
+            if _selected(name):
+                _measure(client.name, name, lambda i: case(client, i))
+        if hasattr(client, 'close'):
+            client.close()
+    # save deferred writes before the dataset is removed
+    app.extensions['datalad_webapp']['writequeue'].flush()
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of files in the dataset')
+    parser.add_argument('--annexed', type=float, default=.5,
+                        help='fraction of annexed files')
+    parser.add_argument('--subdatasets', type=int, default=2,
+                        help='number of subdatasets per dataset')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='nesting depth of subdatasets')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of timed requests per benchmark')
+    parser.add_argument('--server', action='store_true',
+                        help='also benchmark requests via HTTP')
+    parser.add_argument('-k', '--select', metavar='NAME', action='append',
+                        help='only run benchmarks with this name')
+    parser.add_argument('--output', metavar='FILE',
+                        help='file to write the results to (JSON)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown of the median time (ratio) that is '
+                             'considered a regression')
+    parser.add_argument('--keep', action='store_true',
+                        help='do not remove the benchmark dataset')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp(prefix='datalad_webapp_benchmark_')
+    try:
+        # result rendering of DataLad commands must not mix with the report
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            results = run(args, op.join(tmpdir, 'ds'))
+    finally:
+        if args.keep:
+            print('Kept benchmark dataset in {}'.format(tmpdir),
+                  file=sys.stderr)
+        else:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != results['params']:
+            print('Warning: compared runs used different parameters',
+                  file=sys.stderr)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,14 +14,10 @@ __version__ = '0.3'
 
 import logging
 import functools
+from collections import OrderedDict
+import hmac
 
-import os
 import os.path as op
-from pkg_resources import (
-    iter_entry_points,
-    resource_isdir,
-    resource_filename,
-)
 
 from datalad.interface.base import Interface
 from datalad.interface.base import build_doc
@@ -32,7 +28,9 @@ from datalad.distribution.dataset import EnsureDataset
 from datalad.support.constraints import (
     EnsureNone,
     EnsureChoice,
-    EnsureBool
+    EnsureBool,
+    EnsureInt,
+    EnsureRange,
 )
 
 # defines a datalad command suite
@@ -53,24 +51,49 @@ lgr = logging.getLogger('datalad.extension.webapp')
 webapp_props = {}
 
 
-def verify_authentication(view):
+def is_valid_api_key(key):
+    """Check a key against all configured API keys in constant time"""
+    if not isinstance(key, str):
+        return False
+    valid = False
+    for api_key in webapp_props['config']['api_keys']:
+        # no short-circuit, timing must not depend on the matching key
+        valid |= hmac.compare_digest(key.encode(), api_key.encode())
+    return valid
+
+
+def get_request_api_key():
+    """Return the API key presented by a request, or None
+
+    Checked in order: an 'Authorization: Bearer <key>' header, the session,
+    and an 'api_key' field in a JSON request body. The body is only parsed
+    if there is no key elsewhere, and the parsed body is cached by Flask
+    for use by the view.
+    """
     from flask import session
     from flask import request
+
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and token.strip():
+        return token.strip()
+    session_key = session.get('api_key', None)
+    if session_key is not None:
+        return session_key
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            return body.get('api_key', None)
+    return None
+
+
+def verify_authentication(view):
     from flask import abort
 
     @functools.wraps(view)
     def wrapped_view(*args, **kwargs):
-        api_key = webapp_props['config']['api_key']
-        session_key = session.get('api_key', None)
-        request_key = request.get_json()
-        if request_key is not None:
-            request_key = request_key.get('api_key', None)
-        if session_key is None and request_key is None:
-            abort(401)
-        elif session_key == api_key or request_key == api_key:
+        if is_valid_api_key(get_request_api_key()):
             return view(*args, **kwargs)
-        else:
-            abort(401)
+        abort(401)
 
     return wrapped_view
 
@@ -100,15 +123,57 @@ class WebApp(Interface):
             this flag and act accordingly."""),
         mode=Parameter(
             args=("--mode",),
-            constraints=EnsureChoice('normal', 'daemon', 'dry-run', 'debug'),
+            constraints=EnsureChoice(
+                'normal', 'daemon', 'dry-run', 'debug', 'production',
+                'profile'),
             doc="""Execution mode: regular foreground process (normal);
             background process (daemon); no server is started, but all
             configuration is perform (dry-run); like normal, but in debug
-            mode (debug)"""),
+            mode (debug); foreground process with a multi-worker WSGI
+            server, see [CMD: --threads CMD][PY: `threads` PY] and
+            [CMD: --processes CMD][PY: `processes` PY] (production); like
+            normal, but every request is profiled, and the profiles are
+            saved in the .git/datalad_webapp/profiles directory of the
+            dataset (profile). In all modes, individual requests with an
+            'X-Datalad-Profile' header and a valid API key are
+            profiled."""),
+        host=Parameter(
+            args=("--host",),
+            doc="""network interface to bind the server to."""),
+        port=Parameter(
+            args=("--port",),
+            constraints=EnsureInt() & EnsureRange(min=0, max=65535),
+            doc="""port to bind the server to."""),
+        threads=Parameter(
+            args=("--threads",),
+            constraints=EnsureInt() & EnsureRange(min=1),
+            doc="""number of worker threads (per process) in 'production'
+            mode."""),
+        processes=Parameter(
+            args=("--processes",),
+            constraints=EnsureInt() & EnsureRange(min=1),
+            doc="""number of (pre-forked) worker processes in 'production'
+            mode. A single process is served with 'waitress', multiple
+            processes with 'gunicorn'."""),
         static_root=Parameter(
             args=("--static-root",),
             doc="""path to static (HTML) files that should be served in
             root of the webapp. Defaults to the current directory."""),
+        datasets=Parameter(
+            args=("--datasets",),
+            nargs='+',
+            metavar='[ID=]PATH',
+            doc="""serve multiple datasets, instead of a single one. The
+            resources of each dataset are available under
+            '/api/v1/<ID>/'. The ID defaults to the name of the dataset
+            directory."""),
+        max_active=Parameter(
+            args=("--max-active",),
+            constraints=EnsureInt() & EnsureRange(min=1),
+            doc="""maximum number of served datasets whose state (file
+            index, caches, git processes) is kept while they are not
+            used. Only relevant with [CMD: --datasets CMD][PY: `datasets`
+            PY]."""),
         get_apps=Parameter(
             args=('--get-apps',),
             action='store_true',
@@ -119,33 +184,70 @@ class WebApp(Interface):
     @datasetmethod(name='webapp')
     @eval_results
     def __call__(app=None, dataset=None, read_only=False, mode='normal',
-                 static_root=None, get_apps=False):
+                 static_root=None, get_apps=False, host='127.0.0.1',
+                 port=5000, threads=4, processes=1, datasets=None,
+                 max_active=8):
+        from datalad_webapp.app import (
+            create_app,
+            get_app_path,
+            get_entry_point_module,
+            get_entry_points,
+        )
         if get_apps:
-            for ep in iter_entry_points('datalad.webapp.apps'):
+            for ep in get_entry_points('datalad.webapp.apps'):
                 yield dict(
                     action='webapp',
                     status='ok'
-                    if resource_isdir(ep.module_name, ep.load()) else 'error',
+                    if op.isdir(get_app_path(ep)) else 'error',
                     path=ep.name,
                     logger=lgr,
-                    message=("provided by '%s'", ep.module_name))
+                    message=("provided by '%s'", get_entry_point_module(ep)))
             return
 
-        from datalad.distribution.dataset import require_dataset
-        dataset = require_dataset(
-            dataset, check_installed=True, purpose='serving')
+        from datalad.distribution.dataset import (
+            Dataset,
+            require_dataset,
+        )
+        if datasets:
+            specs = datasets
+            datasets = OrderedDict()
+            for spec in specs:
+                dataset_id, sep, path = spec.partition('=')
+                if not sep:
+                    path = spec
+                    dataset_id = op.basename(op.normpath(op.abspath(path)))
+                if not dataset_id or '/' in dataset_id \
+                        or dataset_id in datasets \
+                        or not Dataset(path).is_installed():
+                    yield dict(
+                        action='webapp',
+                        status='error',
+                        path=op.abspath(path),
+                        message=(
+                            "invalid or duplicate dataset ID '%s', or no "
+                            "installed dataset at '%s'", dataset_id, path),
+                    )
+                    return
+                datasets[dataset_id] = op.abspath(path)
+            dataset = None
+            refpath = op.abspath(op.curdir)
+        else:
+            dataset = require_dataset(
+                dataset, check_installed=True, purpose='serving')
+            refpath = dataset.path
 
         if static_root is None and app:
-            for ep in iter_entry_points('datalad.webapp.apps'):
+            for ep in get_entry_points('datalad.webapp.apps'):
                 if ep.name == app:
-                    app_path = resource_filename(ep.module_name, ep.load())
-                    if not resource_isdir(ep.module_name, ep.load()):
+                    app_path = get_app_path(ep)
+                    if not op.isdir(app_path):
                         yield dict(
                             action='webapp',
                             status='error',
-                            path=dataset.path,
+                            path=refpath,
                             message=(
-                                "app entrypoint '%s' does not point to directory",
+                                "app entrypoint '%s' does not point to "
+                                "directory",
                                 app, app_path)
                         )
                         return
@@ -155,63 +257,25 @@ class WebApp(Interface):
                 yield dict(
                     action='webapp',
                     status='error',
-                    path=dataset.path,
+                    path=refpath,
                     message=(
                         "no registered webapp with name '%s'",
                         app)
                 )
                 return
-        elif static_root is None:
-            static_root = op.curdir
-
-        from flask import Flask
-        app = Flask(
-            __name__,
-            root_path=dataset.path,
-            static_url_path='',
-            static_folder=op.abspath(static_root),
-        )
-        app.secret_key = os.urandom(64)
-        # expose via arg
-        app.config['api_key'] = 'dummy'
-
-        webapp_props['config'] = app.config
-
-        from flask_restful import Api
-        api = Api(app, prefix="/api/v1")
-
-        # TODO add default route to static index.html, if one exists
-        # TODO use opt-in model for endpoints to limit exposure of
-        # functionality to what is really needed
-        for ep in iter_entry_points('datalad.webapp.resources'):
-            lgr.warn("Available webapp resource'%s'", ep.name)
-            cls = ep.load()
-            urls = ['/{}'.format(ep.name)]
-            if hasattr(cls, '_urlarg_spec'):
-                urls.append('/{}/{}'.format(ep.name, cls._urlarg_spec))
-
-            api.add_resource(
-                cls,
-                *urls,
-                resource_class_kwargs=dict(
-                    dataset=dataset,
-                )
-            )
-
-        if op.exists(op.join(static_root, 'index.html')):
-            from flask import send_from_directory
 
-            @app.route('/')
-            def serve_index():
-                return send_from_directory(
-                    static_root, 'index.html')
+        app = create_app(
+            dataset, static_root=static_root, read_only=read_only,
+            profile=mode == 'profile', datasets=datasets,
+            max_active=max_active)
 
         if mode == 'dry-run':
             yield dict(
                 action='webapp',
                 status='ok',
                 app=app,
-                path=dataset.path,
+                path=refpath,
+                startup_time=app.config['startup_time'],
             )
             return
 
@@ -228,5 +292,18 @@ class WebApp(Interface):
 *************************************************
 *************************************************
 """)
+        if mode == 'production':
+            from datalad_webapp.serving import serve
+            try:
+                serve(app, host, port, threads=threads, processes=processes)
+            except RuntimeError as e:
+                yield dict(
+                    action='webapp',
+                    status='error',
+                    path=refpath,
+                    message=str(e),
+                )
+            return
+
         # TODO expose flags, or use FLASK config vars
-        app.run(debug=mode == 'debug')
+        app.run(host=host, port=port, debug=mode == 'debug')
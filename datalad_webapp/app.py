@@ -0,0 +1,196 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Factory for webapp (Flask) applications"""
+
+__docformat__ = 'restructuredtext'
+
+import atexit
+import os
+import os.path as op
+import time
+from importlib import import_module
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    # PY < 3.8
+    from importlib_metadata import entry_points
+
+from datalad_webapp import (
+    lgr,
+    webapp_props,
+)
+
+# entry points by group, discovered once per process
+_entry_points = {}
+
+
+def get_entry_points(group):
+    """Return all entry points of a group, in order of their names"""
+    if group not in _entry_points:
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=group)
+        else:
+            # PY < 3.10
+            eps = eps.get(group, [])
+        # the same distribution could be found multiple times on sys.path
+        _entry_points[group] = sorted(
+            {ep.name: ep for ep in eps}.values(),
+            key=lambda ep: ep.name)
+    return _entry_points[group]
+
+
+def get_entry_point_module(ep):
+    """Return the name of the module an entry point refers to"""
+    return ep.value.split(':')[0].strip()
+
+
+def get_app_path(ep):
+    """Return the directory with the static files of a registered webapp"""
+    module = import_module(get_entry_point_module(ep))
+    return op.join(op.dirname(module.__file__), ep.load())
+
+
+def create_app(dataset=None, static_root=None, read_only=False,
+               api_keys=None, profile=False, datasets=None, max_active=8):
+    """Create a Flask app serving a dataset
+
+    The resources registered at the 'datalad.webapp.resources' entry point
+    are set up here. Their modules are expected to be cheap to import, and
+    to defer imports of heavy DataLad modules to their first use.
+
+    Parameters
+    ----------
+    dataset : Dataset or str, optional
+      Dataset to serve. Resources are available at '/api/v1/<resource>'.
+    static_root : str, optional
+      Path to static (HTML) files to serve in the root of the webapp.
+      Defaults to the current directory.
+    read_only : bool
+      Flag whether resources should not modify the dataset.
+    api_keys : list(str), optional
+      Keys that grant access to the API. Defaults to the value(s) of the
+      'datalad.webapp.api-key' configuration, or 'dummy' if there is none.
+    profile : bool
+      Flag whether to profile every request. Otherwise only requests with
+      an 'X-Datalad-Profile' header (and a valid API key) are profiled.
+    datasets : dict, optional
+      Paths of multiple datasets to serve, by dataset ID. Instead of
+      `dataset`. Resources of a dataset are available at
+      '/api/v1/<dataset ID>/<resource>'.
+    max_active : int
+      With `datasets`, the maximum number of datasets whose state (file
+      index, caches, processes) is kept while they are idle.
+
+    Returns
+    -------
+    flask.Flask
+    """
+    t0 = time.time()
+    if static_root is None:
+        static_root = op.curdir
+    if datasets:
+        from datalad import cfg
+        config = cfg
+        root_path = op.abspath(op.curdir)
+    else:
+        from datalad.distribution.dataset import require_dataset
+        dataset = require_dataset(
+            dataset, check_installed=True, purpose='serving')
+        config = dataset.config
+        root_path = dataset.path
+
+    from flask import Flask
+    app = Flask(
+        'datalad_webapp',
+        root_path=root_path,
+        static_url_path='',
+        static_folder=op.abspath(static_root),
+    )
+    app.secret_key = os.urandom(64)
+    if api_keys is None:
+        api_keys = config.get(
+            'datalad.webapp.api-key', 'dummy', get_all=True)
+    if isinstance(api_keys, str):
+        api_keys = [api_keys]
+    app.config['api_keys'] = list(api_keys)
+
+    webapp_props['config'] = app.config
+
+    from flask_restful import Api
+    from datalad_webapp.jsonprovider import output_json
+    api = Api(app, prefix="/api/v1")
+    api.representations['application/json'] = output_json
+
+    from datalad_webapp.pool import (
+        DatasetPool,
+        DatasetState,
+    )
+    if datasets:
+        pool = DatasetPool(datasets, max_active=max_active)
+        pool.init_app(app)
+        # the processes would otherwise outlive the server
+        atexit.register(pool.close)
+        app.extensions['datalad_webapp'] = dict(pool=pool)
+        resource_kwargs = dict(pool=pool)
+        url_prefix = '/<dataset_id>'
+    else:
+        state = DatasetState(dataset)
+        atexit.register(state.close)
+        app.extensions['datalad_webapp'] = state.as_kwargs()
+        resource_kwargs = state.as_kwargs()
+        url_prefix = ''
+
+    # TODO add default route to static index.html, if one exists
+    # TODO use opt-in model for endpoints to limit exposure of
+    # functionality to what is really needed
+    for ep in get_entry_points('datalad.webapp.resources'):
+        t_ep = time.time()
+        cls = ep.load()
+        lgr.debug("Available webapp resource '%s' (loaded in %.3fs)",
+                  ep.name, time.time() - t_ep)
+        urls = ['{}/{}'.format(url_prefix, ep.name)]
+        if hasattr(cls, '_urlarg_spec'):
+            urls.append('{}/{}/{}'.format(
+                url_prefix, ep.name, cls._urlarg_spec))
+
+        api.add_resource(
+            cls,
+            *urls,
+            resource_class_kwargs=dict(
+                resource_kwargs,
+                read_only=read_only,
+            )
+        )
+
+    if op.exists(op.join(static_root, 'index.html')):
+        from flask import send_from_directory
+
+        @app.route('/')
+        def serve_index():
+            return send_from_directory(
+                static_root, 'index.html')
+
+    # registered first, to include all other request hooks
+    from datalad_webapp import profiling
+    profiling.init_app(app, dataset, always=profile)
+
+    # registered before compression, to record compressed response sizes
+    from datalad_webapp import metrics
+    metrics.init_app(app)
+
+    from datalad_webapp import compression
+    compression.init_app(app)
+
+    app.config['startup_time'] = time.time() - t0
+    lgr.info('Webapp for %s set up in %.3fs',
+             dataset or '{} datasets'.format(len(datasets)),
+             app.config['startup_time'])
+    return app
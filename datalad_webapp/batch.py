@@ -0,0 +1,261 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Long-running git and git-annex processes in batch mode"""
+
+__docformat__ = 'restructuredtext'
+
+import json
+import os.path as op
+import queue
+import subprocess
+import threading
+
+import logging
+lgr = logging.getLogger('datalad.webapp.batch')
+
+
+def _read_line(stdout):
+    line = stdout.readline()
+    if not line:
+        raise EOFError('batch process exited')
+    return line.rstrip(b'\n').decode('utf-8')
+
+
+def _read_object(stdout):
+    # output of 'git cat-file --batch'
+    header = _read_line(stdout).split()
+    if len(header) != 3:
+        # '<object> missing' or '<object> ambiguous'
+        return None
+    sha, type_, size = header
+    content = stdout.read(int(size))
+    # trailing newline
+    stdout.read(1)
+    return sha, type_, content
+
+
+def _read_object_info(stdout):
+    # output of 'git cat-file --batch-check'
+    header = _read_line(stdout).split()
+    if len(header) != 3:
+        return None
+    sha, type_, size = header
+    return sha, type_, int(size)
+
+
+class BatchProcess(object):
+    """A process that answers requests (lines on stdin) one at a time
+
+    The process is started on the first request, and restarted if it
+    exited in between.
+
+    Parameters
+    ----------
+    cmd : list(str)
+    cwd : str
+    """
+    def __init__(self, cmd, cwd):
+        self.cmd = cmd
+        self.cwd = cwd
+        self._lock = threading.Lock()
+        self._proc = None
+
+    def _start(self):
+        lgr.debug('Starting batch process %s in %s', self.cmd, self.cwd)
+        self._proc = subprocess.Popen(
+            self.cmd,
+            cwd=self.cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def request(self, line, read_response=_read_line):
+        """Send a request and return the response
+
+        Parameters
+        ----------
+        line : str
+          Request, without line ending.
+        read_response : callable
+          Called with the (binary) stdout of the process to read the
+          response. By default, a single line is read.
+
+        Raises
+        ------
+        RuntimeError
+          If the process failed twice in a row.
+        """
+        if '\n' in line:
+            raise ValueError('batch requests must be single lines')
+        with self._lock:
+            for attempt in (1, 2):
+                if self._proc is None or self._proc.poll() is not None:
+                    self._start()
+                try:
+                    self._proc.stdin.write(line.encode('utf-8') + b'\n')
+                    self._proc.stdin.flush()
+                    return read_response(self._proc.stdout)
+                except (OSError, EOFError) as e:
+                    lgr.debug('Batch process %s failed: %s', self.cmd, e)
+                    self._stop()
+            raise RuntimeError(
+                "batch process '{}' failed".format(' '.join(self.cmd)))
+
+    def _stop(self, timeout=5):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            # closing stdin ends batch mode
+            proc.stdin.close()
+            proc.wait(timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+
+class BatchProcessPool(object):
+    """Up to `size` batch processes running the same command"""
+    def __init__(self, cmd, cwd, size=1):
+        self._processes = [BatchProcess(cmd, cwd) for i in range(size)]
+        # most recently used first, to keep the number of running
+        # processes low
+        self._idle = queue.LifoQueue()
+        for p in self._processes:
+            self._idle.put(p)
+
+    def request(self, line, read_response=_read_line):
+        """See `BatchProcess.request()`"""
+        process = self._idle.get()
+        try:
+            return process.request(line, read_response)
+        finally:
+            self._idle.put(process)
+
+    def close(self):
+        for p in self._processes:
+            p.close()
+
+
+class BatchedRepo(object):
+    """Batch mode git and git-annex processes for a dataset
+
+    Processes are started on first use, and shared by all threads.
+
+    Parameters
+    ----------
+    dataset : Dataset
+    size : int
+      Maximum number of processes per command.
+    get_size : int
+      Maximum number of 'git annex get' processes, i.e. of parallel
+      content retrievals.
+    """
+    def __init__(self, dataset, size=2, get_size=4):
+        self.ds = dataset
+        self._annex_dir = op.join(str(dataset.repo.dot_git), 'annex')
+        self.size = size
+        self.get_size = get_size
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    @property
+    def is_annex(self):
+        return op.isdir(self._annex_dir)
+
+    def _request(self, cmd, line, read_response=_read_line):
+        key = tuple(cmd)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = BatchProcessPool(
+                    cmd, self.ds.path,
+                    self.get_size if cmd[:3] == ['git', 'annex', 'get']
+                    else self.size)
+        return pool.request(line, read_response)
+
+    def _annex(self, command, path, json_output=False):
+        cmd = ['git', 'annex', command, '--batch']
+        if json_output:
+            cmd.extend(['--json', '--json-error-messages'])
+        res = self._request(cmd, self._relpath(path))
+        if not json_output:
+            return res or None
+        return json.loads(res) if res else None
+
+    def _relpath(self, path):
+        if op.isabs(path):
+            path = op.relpath(path, self.ds.path)
+        return path
+
+    def cat_file(self, ref):
+        """Return a git object
+
+        Parameters
+        ----------
+        ref : str
+          Anything `git cat-file` understands, e.g. a blob SHA, or
+          '<commit>:<path>'.
+
+        Returns
+        -------
+        tuple(str, str, bytes) or None
+          SHA, type, and content of the object, or None if there is no
+          such object.
+        """
+        return self._request(
+            ['git', 'cat-file', '--batch'], ref, _read_object)
+
+    def cat_file_check(self, ref):
+        """Return the SHA, type, and size of a git object, without its
+        content, or None if there is no such object"""
+        return self._request(
+            ['git', 'cat-file', '--batch-check'], ref, _read_object_info)
+
+    def lookupkey(self, path):
+        """Return the annex key of a file, or None if it is not annexed"""
+        if not self.is_annex:
+            return None
+        return self._annex('lookupkey', path)
+
+    def contentlocation(self, key):
+        """Return the absolute path of an annex key's content, or None if
+        it is not present"""
+        if not self.is_annex:
+            return None
+        location = self._request(
+            ['git', 'annex', 'contentlocation', '--batch'], key)
+        return op.join(self.ds.path, location) if location else None
+
+    def get(self, path):
+        """Retrieve the content of an annexed file
+
+        Returns
+        -------
+        dict or None
+          The `git annex get` record, or None if there was nothing to do
+          (content present, or not an annexed file).
+        """
+        if not self.is_annex:
+            return None
+        return self._annex('get', path, json_output=True)
+
+    def close(self):
+        """Stop all processes"""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
@@ -0,0 +1,131 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Cache for results of DataLad commands run on a dataset"""
+
+__docformat__ = 'restructuredtext'
+
+import threading
+import time
+from collections import OrderedDict
+
+from datalad_webapp.metrics import metrics
+
+import logging
+lgr = logging.getLogger('datalad.webapp.cache')
+
+
+def get_head_commit(dot_git):
+    """Return the commit SHA of HEAD in a repository, without calling git
+
+    Parameters
+    ----------
+    dot_git : pathlib.Path
+      The .git directory of the repository.
+
+    Returns
+    -------
+    str or None
+      None, if HEAD does not point to a commit (yet).
+    """
+    head = (dot_git / 'HEAD').read_text().strip()
+    if not head.startswith('ref:'):
+        # detached HEAD
+        return head
+    ref = head[4:].strip()
+    ref_file = dot_git / ref
+    if ref_file.exists():
+        return ref_file.read_text().strip()
+    packed_refs = dot_git / 'packed-refs'
+    if packed_refs.exists():
+        for line in packed_refs.read_text().splitlines():
+            if line.endswith(' ' + ref):
+                return line.split(' ', 1)[0]
+    return None
+
+
+class ResultCache(object):
+    """Size-bounded, expiring cache of command results
+
+    Results are cached per command name and arguments, and are only valid
+    for the HEAD commit of the dataset at the time they were produced.
+    The least recently used result is evicted when the cache is full.
+
+    Parameters
+    ----------
+    dataset : Dataset
+    maxsize : int
+      Maximum number of cached results.
+    ttl : float
+      Number of seconds after which a cached result expires, even if
+      HEAD did not change (e.g. to pick up configuration changes).
+    """
+    def __init__(self, dataset, maxsize=128, ttl=300):
+        self.ds = dataset
+        # looked up once, `Dataset.repo` checks the repository on access
+        self._dot_git = dataset.repo.dot_git
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+
+    def get(self, name, args, func):
+        """Return the (cached) result of a command
+
+        Parameters
+        ----------
+        name : str
+          Name of the command.
+        args : dict
+          Arguments of the command, values must be hashable.
+        func : callable
+          Called without arguments to produce the result on a cache miss.
+          Any iterable it returns is converted to a list.
+
+        Returns
+        -------
+        list
+        """
+        key = (
+            name,
+            get_head_commit(self._dot_git),
+            tuple(sorted(args.items())),
+        )
+        now = time.time()
+        with self._lock:
+            hit = self._results.get(key)
+            if hit is not None and now - hit[0] < self.ttl:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return hit[1]
+            self.misses += 1
+        with metrics.time_datalad_call(name):
+            res = list(func())
+        with self._lock:
+            self._results[key] = (now, res)
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return res
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                size=len(self._results),
+                maxsize=self.maxsize,
+                ttl=self.ttl,
+            )
@@ -0,0 +1,190 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Response compression, negotiated via Accept-Encoding"""
+
+__docformat__ = 'restructuredtext'
+
+import mimetypes
+import os.path as op
+import zlib
+
+import logging
+lgr = logging.getLogger('datalad.webapp.compression')
+
+# file name extensions of pre-compressed static files
+sidecar_extensions = {
+    'zstd': '.zst',
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+# content encodings a response may be compressed with
+content_encodings = ('zstd', 'br', 'gzip')
+
+# mimetypes worth compressing (besides text/*)
+compressible_mimetypes = {
+    'application/json',
+    'application/x-ndjson',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+}
+
+
+class _GzipCompressor(object):
+    def __init__(self):
+        self._obj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+class _BrotliCompressor(object):
+    def __init__(self):
+        import brotli
+        self._obj = brotli.Compressor()
+
+    def compress(self, data):
+        return self._obj.process(data) + self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+class _ZstdCompressor(object):
+    def __init__(self):
+        import zstandard
+        self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self._obj = zstandard.ZstdCompressor().compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data) + self._obj.flush(self._flush_mode)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+def get_compressors():
+    """Return the available compressor classes by content encoding
+
+    In order of preference. Brotli and zstd are only available when the
+    `brotli` and `zstandard` packages are installed.
+    """
+    compressors = {}
+    try:
+        import zstandard
+        compressors['zstd'] = _ZstdCompressor
+    except ImportError:
+        pass
+    try:
+        import brotli
+        compressors['br'] = _BrotliCompressor
+    except ImportError:
+        pass
+    compressors['gzip'] = _GzipCompressor
+    return compressors
+
+
+def get_encoded_etag(etag, encoding):
+    """Return the ETag of a compressed variant of a response
+
+    A strong ETag must differ for each content encoding.
+    """
+    return '{}-{}'.format(etag, encoding)
+
+
+def _is_compressible(mimetype):
+    return mimetype is not None and (
+        mimetype.startswith('text/') or mimetype in compressible_mimetypes)
+
+
+def _compress_iter(compressor, chunks):
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def init_app(app, min_size=500):
+    """Enable response compression for a Flask app
+
+    Any (non-partial) response of a compressible type and at least
+    `min_size` bytes is compressed with the best encoding accepted by the
+    client. Streamed responses are compressed chunk by chunk. For static
+    files a pre-compressed sidecar file (e.g. `app.js.gz` for `app.js`)
+    is sent instead, if one exists.
+
+    Parameters
+    ----------
+    app : flask.Flask
+    min_size : int
+      Minimum size (in bytes) of a response to be compressed.
+    """
+    from flask import (
+        request,
+        send_from_directory,
+    )
+    compressors = get_compressors()
+
+    def _get_encoding(candidates):
+        return request.accept_encodings.best_match(list(candidates))
+
+    @app.before_request
+    def serve_sidecar():
+        if request.endpoint == 'static':
+            filename = request.view_args.get('filename')
+        elif request.endpoint == 'serve_index':
+            filename = 'index.html'
+        else:
+            return None
+        if not filename or not app.static_folder:
+            return None
+        encoding = _get_encoding(
+            e for e, ext in sidecar_extensions.items()
+            if op.isfile(op.join(app.static_folder, filename + ext)))
+        if encoding is None:
+            return None
+        rv = send_from_directory(
+            app.static_folder, filename + sidecar_extensions[encoding])
+        rv.mimetype = mimetypes.guess_type(filename)[0] \
+            or 'application/octet-stream'
+        rv.headers['Content-Encoding'] = encoding
+        rv.vary.add('Accept-Encoding')
+        return rv
+
+    @app.after_request
+    def compress_response(rv):
+        if rv.status_code not in (200, 201, 202) \
+                or request.method == 'HEAD' \
+                or 'Content-Encoding' in rv.headers \
+                or rv.direct_passthrough \
+                or not _is_compressible(rv.mimetype):
+            return rv
+        rv.vary.add('Accept-Encoding')
+        if not rv.is_streamed and rv.calculate_content_length() < min_size:
+            return rv
+        encoding = _get_encoding(compressors)
+        if encoding is None:
+            return rv
+        compressor = compressors[encoding]()
+        if rv.is_streamed:
+            rv.response = _compress_iter(
+                compressor, rv.iter_encoded())
+            rv.headers.pop('Content-Length', None)
+        else:
+            rv.set_data(
+                compressor.compress(rv.get_data()) + compressor.finish())
+        rv.headers['Content-Encoding'] = encoding
+        etag, weak = rv.get_etag()
+        if etag:
+            rv.set_etag(get_encoded_etag(etag, encoding), weak)
+        return rv
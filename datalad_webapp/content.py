@@ -0,0 +1,248 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Helpers for serving raw file content"""
+
+__docformat__ = 'restructuredtext'
+
+import hashlib
+import mimetypes
+import os
+import os.path as op
+import threading
+from collections import OrderedDict
+from itertools import islice
+from lzma import (
+    LZMAError,
+    LZMAFile,
+)
+
+from datalad.support import json_py
+from datalad_webapp.httpcache import set_cache_headers
+from datalad_webapp.jsonprovider import dumpb
+
+import logging
+lgr = logging.getLogger('datalad.webapp.content')
+
+# size of the chunks content is read and sent in
+chunk_size = 1024 * 1024
+
+# the content of unlocked annexed files without content starts with this
+_pointer_prefix = b'/annex/objects/'
+# git-annex does not consider larger files to be pointer files
+_max_pointer_size = 32 * 1024
+
+# git blob SHAs of (unannexed) file content, keyed by path and file stats
+_blobsha_cache = OrderedDict()
+_blobsha_cache_size = 10000
+_blobsha_cache_lock = threading.Lock()
+
+
+def get_annex_key(path):
+    """Return the annex key of a locked annexed file, or None
+
+    No git or git-annex call is made, the key is taken from the target of
+    the annex symlink.
+    """
+    if not op.islink(path):
+        return None
+    target = os.readlink(path)
+    if '/annex/objects/' not in target.replace(op.sep, '/'):
+        return None
+    return op.basename(target)
+
+
+def has_local_content(path):
+    """Cheap test whether file content is locally available
+
+    No git or git-annex call is made. A locked annexed file has content if
+    its symlink resolves to an existing file, an unlocked annexed file has
+    no content as long as it is a pointer file. Anything else is considered
+    to be present if it exists.
+    """
+    if not op.exists(path):
+        # includes broken symlinks
+        return False
+    if op.islink(path):
+        return True
+    if os.stat(path).st_size > _max_pointer_size:
+        return True
+    with open(path, 'rb') as f:
+        return f.read(len(_pointer_prefix)) != _pointer_prefix
+
+
+def get_blob_sha(path, stat=None):
+    """Return the git blob SHA of a file's content
+
+    The SHA is computed from the content in the working tree (identical to
+    `git hash-object`), and cached for as long as the file stats do not
+    change.
+    """
+    stat = stat or os.stat(path)
+    cache_key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _blobsha_cache_lock:
+        sha = _blobsha_cache.get(cache_key)
+    if sha is not None:
+        return sha
+    hasher = hashlib.sha1(b'blob %d\0' % stat.st_size)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    sha = hasher.hexdigest()
+    with _blobsha_cache_lock:
+        _blobsha_cache[cache_key] = sha
+        while len(_blobsha_cache) > _blobsha_cache_size:
+            _blobsha_cache.popitem(last=False)
+    return sha
+
+
+def send_content(path, etag=None, immutable=False):
+    """Create a response that streams the content of a file
+
+    The response is conditional (If-None-Match, If-Modified-Since) and
+    supports HTTP Range requests. Content is never loaded into memory as
+    a whole.
+
+    Parameters
+    ----------
+    path : str
+      Absolute path of the file to send.
+    etag : str, optional
+      If given, the (strong) ETag for the file content.
+    immutable : bool
+      Flag whether the content can be cached forever, see
+      `set_cache_headers()`.
+
+    Returns
+    -------
+    flask.Response
+    """
+    from flask import (
+        current_app,
+        request,
+    )
+    from werkzeug.wsgi import wrap_file
+
+    stat = os.stat(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    rv = current_app.response_class(
+        wrap_file(request.environ, open(path, 'rb'), buffer_size=chunk_size),
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    rv.content_length = stat.st_size
+    rv.last_modified = int(stat.st_mtime)
+    # not all werkzeug versions announce it for non-range requests
+    rv.headers['Accept-Ranges'] = 'bytes'
+    if etag:
+        set_cache_headers(rv, etag, immutable=immutable)
+    return rv.make_conditional(
+        request, accept_ranges=True, complete_length=stat.st_size)
+
+
+def iter_json_stream(path, offset=0, limit=None, fields=None):
+    """Yield the records of a JSON stream (JSON-lines) file one by one
+
+    Records are parsed lazily. Lines before `offset` are skipped without
+    being decoded, and reading stops after `limit` records.
+
+    Parameters
+    ----------
+    path : str
+      Path of the file, it is read via LZMA decompression if the name
+      ends with '.xz' (like `json_py.load_stream()` does).
+    offset : int
+      Number of records to skip.
+    limit : int, optional
+      Maximum number of records to yield.
+    fields : list(str), optional
+      If given, only these fields of any dict-type record are reported.
+
+    Raises
+    ------
+    ValueError
+      When a record cannot be read or decoded, after all records before
+      it were yielded.
+    """
+    _open = LZMAFile if path.endswith('.xz') else open
+    with _open(path, 'rb') as f:
+        lines = (line for line in f if line.strip())
+        stop = None if limit is None else offset + limit
+        recno = offset
+        try:
+            for recno, line in enumerate(islice(lines, offset, stop),
+                                         start=offset):
+                rec = json_py.loads(line.decode('utf-8'))
+                if fields and isinstance(rec, dict):
+                    rec = {k: rec[k] for k in fields if k in rec}
+                yield rec
+        except (ValueError, EOFError, LZMAError) as e:
+            raise ValueError(
+                'cannot decode JSON stream record {}: {}'.format(
+                    recno + 1, e))
+
+
+def _get_stream_error(e):
+    lgr.debug('Failed to stream records: %s', e)
+    return str(e)
+
+
+def ndjson_response(records):
+    """Create a response that streams records as newline-delimited JSON
+
+    If the records fail with a ValueError while they are sent, the stream
+    ends with an ``{"error": <message>}`` record.
+    """
+    from flask import current_app
+
+    def gen():
+        try:
+            for r in records:
+                yield dumpb(r) + b'\n'
+        except ValueError as e:
+            yield dumpb({'error': _get_stream_error(e)}) + b'\n'
+
+    return current_app.response_class(
+        gen(), mimetype='application/x-ndjson')
+
+
+def json_array_response(records, key, props=None):
+    """Create a response that streams records as an array in a JSON object
+
+    The response body is identical to that of
+    ``jsonify(dict(props, **{key: list(records)}))``, but records are
+    encoded and sent one at a time. If the records fail with a ValueError
+    while they are sent, the array ends early, and the object gets an
+    'error' property with the message.
+
+    Parameters
+    ----------
+    records : iterable
+      Records to encode as the elements of the array.
+    key : str
+      Name of the property the array is assigned to.
+    props : dict, optional
+      Additional properties of the JSON object.
+    """
+    from flask import current_app
+
+    def gen():
+        yield b'{'
+        for k, v in (props or {}).items():
+            yield dumpb(k) + b':' + dumpb(v) + b','
+        yield dumpb(key) + b':['
+        try:
+            for i, r in enumerate(records):
+                yield (b',' if i else b'') + dumpb(r)
+        except ValueError as e:
+            yield b'],' + dumpb('error') + b':' + dumpb(
+                _get_stream_error(e)) + b'}\n'
+            return
+        yield b']}\n'
+
+    return current_app.response_class(gen(), mimetype='application/json')
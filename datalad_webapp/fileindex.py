@@ -0,0 +1,235 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""In-process index of the files tracked in a dataset"""
+
+__docformat__ = 'restructuredtext'
+
+import os.path as op
+import re
+import subprocess
+import threading
+from bisect import (
+    bisect_left,
+    bisect_right,
+)
+from fnmatch import fnmatch
+
+from datalad_webapp.cache import get_head_commit
+
+import logging
+lgr = logging.getLogger('datalad.webapp.fileindex')
+
+# anything that makes fnmatch do more than a literal comparison
+_wildcard_regex = re.compile(r'[*?[]')
+
+
+def get_literal_prefix(pattern):
+    """Return the leading part of a glob pattern without any wildcards"""
+    match = _wildcard_regex.search(pattern)
+    return pattern if match is None else pattern[:match.start()]
+
+
+class FileIndex(object):
+    """Cached list of all files in the git index of a dataset
+
+    The list is obtained once via `get_indexed_files()` and kept in memory.
+    Before it is used, the modification time and size of the git index and
+    HEAD are compared to the state at the time the list was built. Any
+    change (by this or any other process) triggers a rebuild. Modifications
+    made by the webapp itself can be reported via `update()` to avoid such
+    a full rebuild.
+    """
+    def __init__(self, dataset):
+        self.ds = dataset
+        # looked up once, `Dataset.repo` checks the repository on access
+        self._dot_git = dataset.repo.dot_git
+        self._lock = threading.Lock()
+        self._files = None
+        self._stamp = None
+        # built on demand, reset whenever the file list changes
+        self._keys = None
+
+    def _get_stamp(self):
+        dot_git = self._dot_git
+        stamp = []
+        for fname in ('index', 'HEAD'):
+            try:
+                st = (dot_git / fname).stat()
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @property
+    def version(self):
+        """State of the repository the file list is derived from
+
+        A tuple of the HEAD commit and the modification time and size of
+        the git index (and HEAD). Changes whenever the file list may have.
+        """
+        return get_head_commit(self._dot_git), self._get_stamp()
+
+    @property
+    def files(self):
+        """Sorted list of all files in the index (relative POSIX paths)"""
+        stamp = self._get_stamp()
+        with self._lock:
+            if self._files is None or stamp != self._stamp:
+                lgr.debug('(Re)building file index for %s', self.ds)
+                self._files = sorted(self.ds.repo.get_indexed_files())
+                self._stamp = stamp
+                self._keys = None
+            return self._files
+
+    @property
+    def keys(self):
+        """Annex key of each annexed file, git blob SHA of any other file
+
+        Subdatasets are not included. Built on first access, and whenever
+        the file list changed.
+
+        Returns
+        -------
+        dict
+          By path.
+        """
+        # refreshes the file list, if needed
+        self.files
+        with self._lock:
+            if self._keys is None:
+                lgr.debug('Reading keys of the files in %s', self.ds)
+                self._keys = self._read_keys()
+            return self._keys
+
+    def _read_keys(self):
+        repo = self.ds.repo
+        keys = {
+            p.relative_to(repo.pathobj).as_posix(): props['gitshasum']
+            for p, props in repo.get_content_info(
+                ref=None, untracked='no', eval_file_type=False).items()
+            if props.get('type') != 'dataset' and 'gitshasum' in props
+        }
+        if (self._dot_git / 'annex').is_dir():
+            # all annexed files, locked or not, with content or not
+            out = subprocess.run(
+                ['git', 'annex', 'find', '--include=*',
+                 '--format=${key} ${file}\\n'],
+                cwd=self.ds.path,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ).stdout.decode('utf-8')
+            for line in out.splitlines():
+                key, _, path = line.partition(' ')
+                if path in keys:
+                    keys[path] = key
+        return keys
+
+    def glob(self, pattern='*', start_after=None, limit=None):
+        """Return files matching a glob pattern
+
+        Only the range of the sorted file list that shares the literal
+        prefix of the pattern (e.g. 'sub/dir/' for 'sub/dir/*') is
+        inspected.
+
+        Parameters
+        ----------
+        pattern : str
+          Glob pattern, as understood by `fnmatch`.
+        start_after : str, optional
+          Only report files that sort after this path. Used for paginating
+          through the matches.
+        limit : int, optional
+          Maximum number of files to report.
+
+        Returns
+        -------
+        list(str)
+        """
+        files = self.files
+        prefix = get_literal_prefix(pattern)
+        start = bisect_left(files, prefix)
+        if start_after is not None:
+            start = max(start, bisect_right(files, start_after))
+        matches = []
+        for i in range(start, len(files)):
+            f = files[i]
+            if not f.startswith(prefix):
+                # sorted list, there can be no further match
+                break
+            if fnmatch(f, pattern):
+                matches.append(f)
+                if limit and len(matches) >= limit:
+                    break
+        return matches
+
+    def update(self, added=None, removed=None):
+        """Incrementally update the index after a known modification
+
+        Parameters
+        ----------
+        added : list(str), optional
+          Paths (relative to the dataset root) that are now in the index.
+        removed : list(str), optional
+          Paths (relative to the dataset root) that are no longer in the
+          index.
+        """
+        stamp = self._get_stamp()
+        with self._lock:
+            if self._files is None:
+                # nothing to update, will be built on next access
+                return
+            files = set(self._files)
+            files.difference_update(removed or [])
+            files.update(added or [])
+            self._files = sorted(files)
+            self._stamp = stamp
+            self._keys = None
+
+    def update_from_results(self, results, added=None, removed=None):
+        """Update the index after a save or removal, as far as confirmed
+
+        Only paths that the results report as added to (or removed from)
+        this dataset are applied. If any of the given paths is not
+        confirmed, e.g. a path inside a subdataset, the index is rebuilt
+        on next access instead.
+
+        Parameters
+        ----------
+        results : list(dict)
+          Results of `save` or `remove`.
+        added : list(str), optional
+          Paths (relative to the dataset root) meant to be added.
+        removed : list(str), optional
+          Paths (relative to the dataset root) meant to be removed.
+        """
+        confirmed = {}
+        for r in results:
+            if r.get('type') != 'file' \
+                    or r.get('status') not in ('ok', 'notneeded') \
+                    or (r.get('parentds') or r.get('refds')) != self.ds.path:
+                continue
+            confirmed[op.relpath(r['path'], self.ds.path).replace(
+                op.sep, '/')] = r.get('action')
+        added = set(added or [])
+        removed = set(removed or [])
+        if any(confirmed.get(p) != 'add' for p in added) or any(
+                confirmed.get(p) not in ('delete', 'remove')
+                for p in removed):
+            lgr.debug('Modification of %s not confirmed, rebuilding the '
+                      'file index', self.ds)
+            self.invalidate()
+            return
+        self.update(added=added, removed=removed)
+
+    def invalidate(self):
+        """Force a rebuild on next access"""
+        with self._lock:
+            self._files = None
+            self._stamp = None
+            self._keys = None
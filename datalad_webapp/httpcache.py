@@ -0,0 +1,146 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""HTTP cache validators (ETag, Last-Modified) derived from git state"""
+
+__docformat__ = 'restructuredtext'
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import logging
+lgr = logging.getLogger('datalad.webapp.httpcache')
+
+# Cache-Control of responses that can change under the same URL: they
+# can be stored, but must be revalidated with their ETag before reuse
+revalidate_cache_control = 'no-cache'
+# Cache-Control of content addressed by its annex key or git blob SHA
+immutable_cache_control = 'max-age=31536000, immutable'
+
+# committer timestamps by commit SHA, commits never change
+_commit_times = OrderedDict()
+_commit_times_size = 1000
+_commit_times_lock = threading.Lock()
+
+
+def make_etag(*parts):
+    """Return a strong ETag value for a combination of (state) values"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def get_commit_time(batch, sha):
+    """Return the committer timestamp of a commit
+
+    Parameters
+    ----------
+    batch : BatchedRepo
+      Used to read the commit object.
+    sha : str or None
+
+    Returns
+    -------
+    int or None
+      None, if there is no such commit.
+    """
+    if sha is None:
+        return None
+    with _commit_times_lock:
+        timestamp = _commit_times.get(sha)
+    if timestamp is not None:
+        return timestamp
+    obj = batch.cat_file(sha)
+    if obj is None or obj[1] != 'commit':
+        return None
+    for line in obj[2].decode('utf-8', 'replace').splitlines():
+        if not line:
+            # end of the header
+            break
+        if line.startswith('committer '):
+            # committer <name> <email> <timestamp> <tz>
+            timestamp = int(line.rsplit(' ', 2)[1])
+            break
+    if timestamp is None:
+        return None
+    with _commit_times_lock:
+        _commit_times[sha] = timestamp
+        while len(_commit_times) > _commit_times_size:
+            _commit_times.popitem(last=False)
+    return timestamp
+
+
+def get_matching_etag(etag):
+    """Return the variant of an ETag that the current request refers to
+
+    Compressed responses carry an ETag with the content encoding appended
+    (see `compression.get_encoded_etag()`), any of them matches.
+
+    Returns
+    -------
+    str or None
+      None, if the request has no matching If-None-Match header.
+    """
+    from flask import request
+    from datalad_webapp.compression import (
+        content_encodings,
+        get_encoded_etag,
+    )
+    if not request.if_none_match:
+        return None
+    candidates = [etag] + [
+        get_encoded_etag(etag, e) for e in content_encodings]
+    for candidate in candidates:
+        if request.if_none_match.contains_weak(candidate):
+            return candidate
+    return None
+
+
+def set_cache_headers(rv, etag, last_modified=None, immutable=False):
+    """Set the ETag, Last-Modified and Cache-Control headers of a response
+
+    Parameters
+    ----------
+    rv : flask.Response
+    etag : str
+      Strong ETag value.
+    last_modified : int or datetime, optional
+    immutable : bool
+      Flag whether the response never changes, e.g. content that is
+      addressed by its key. Otherwise, caches must revalidate it.
+
+    Returns
+    -------
+    flask.Response
+    """
+    rv.set_etag(etag)
+    if last_modified is not None:
+        rv.last_modified = last_modified
+    rv.headers['Cache-Control'] = immutable_cache_control if immutable \
+        else revalidate_cache_control
+    return rv
+
+
+def not_modified(etag, last_modified=None, immutable=False):
+    """Return a 304 (Not Modified) response, if the client has the response
+
+    To be called before doing any work to build the actual response.
+    Only If-None-Match is considered, as the ETag identifies the state of
+    the response exactly.
+
+    Returns
+    -------
+    flask.Response or None
+      None, if the request does not carry a matching If-None-Match header.
+    """
+    from flask import current_app
+    matched = get_matching_etag(etag)
+    if matched is None:
+        return None
+    return set_cache_headers(
+        current_app.response_class(status=304),
+        matched, last_modified, immutable)
@@ -0,0 +1,92 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""JSON serialization of API responses with a pluggable backend"""
+
+__docformat__ = 'restructuredtext'
+
+import json
+
+import logging
+lgr = logging.getLogger('datalad.webapp.jsonprovider')
+
+
+def _default(obj):
+    # anything else that can show up in results, e.g. pathlib paths
+    return str(obj)
+
+
+def _json_dumpb(obj):
+    return json.dumps(
+        obj, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def _orjson_dumpb(obj):
+    import orjson
+    return orjson.dumps(
+        obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+# serializers by name, each takes an object and returns UTF-8 encoded JSON
+backends = {
+    'json': _json_dumpb,
+    'orjson': _orjson_dumpb,
+}
+
+_dumpb = None
+
+
+def set_backend(name=None):
+    """Select the JSON serialization backend
+
+    Parameters
+    ----------
+    name : str, optional
+      Name of a registered backend (see `backends`). By default 'orjson'
+      is used if it is installed, and the standard library 'json' module
+      otherwise.
+    """
+    global _dumpb
+    if name is None:
+        try:
+            import orjson
+            name = 'orjson'
+        except ImportError:
+            name = 'json'
+    lgr.debug('Using JSON backend %s', name)
+    _dumpb = backends[name]
+
+
+def dumpb(obj):
+    """Serialize an object to UTF-8 encoded JSON"""
+    if _dumpb is None:
+        set_backend()
+    return _dumpb(obj)
+
+
+def dumps(obj):
+    """Serialize an object to a JSON string"""
+    return dumpb(obj).decode('utf-8')
+
+
+def jsonify(obj, status=None):
+    """Like `flask.jsonify()` for a single object, but with the selected
+    backend"""
+    from flask import current_app
+    return current_app.response_class(
+        dumpb(obj) + b'\n',
+        status=status,
+        mimetype='application/json',
+    )
+
+
+def output_json(data, code, headers=None):
+    """flask_restful representation for 'application/json'"""
+    rv = jsonify(data, status=code)
+    rv.headers.extend(headers or {})
+    return rv
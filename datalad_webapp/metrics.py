@@ -0,0 +1,217 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Request metrics in Prometheus text exposition format"""
+
+__docformat__ = 'restructuredtext'
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import logging
+lgr = logging.getLogger('datalad.webapp.metrics')
+
+# upper bounds (in seconds) of the latency histogram buckets
+latency_buckets = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+prefix = 'datalad_webapp_'
+
+
+def _format_labels(names, values):
+    return ','.join(
+        '{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for n, v in zip(names, values))
+
+
+class Counter(object):
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, labels=(), value=1):
+        # caller holds the registry lock
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def expose(self):
+        yield '# HELP {}{} {}'.format(prefix, self.name, self.doc)
+        yield '# TYPE {}{} counter'.format(prefix, self.name)
+        for labels, value in sorted(self._values.items()):
+            yield '{}{}{} {}'.format(
+                prefix, self.name,
+                '{{{}}}'.format(_format_labels(self.labels, labels))
+                if labels else '',
+                value)
+
+
+class Histogram(object):
+    def __init__(self, name, doc, labels=(), buckets=latency_buckets):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        # caller holds the registry lock
+        counts = self._values.get(labels)
+        if counts is None:
+            # one count per bucket, +Inf, sum
+            counts = self._values[labels] = [0] * (len(self.buckets) + 1) \
+                + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def expose(self):
+        yield '# HELP {}{} {}'.format(prefix, self.name, self.doc)
+        yield '# TYPE {}{} histogram'.format(prefix, self.name)
+        for labels, counts in sorted(self._values.items()):
+            label_str = _format_labels(self.labels, labels)
+            cumulative = 0
+            for le, count in zip(
+                    [str(b) for b in self.buckets] + ['+Inf'], counts[:-1]):
+                cumulative += count
+                yield '{}{}_bucket{{{}}} {}'.format(
+                    prefix, self.name,
+                    ','.join(filter(None, [label_str, 'le="{}"'.format(le)])),
+                    cumulative)
+            suffix = '{{{}}}'.format(label_str) if label_str else ''
+            yield '{}{}_sum{} {}'.format(prefix, self.name, suffix, counts[-1])
+            yield '{}{}_count{} {}'.format(
+                prefix, self.name, suffix, cumulative)
+
+
+class Metrics(object):
+    """Registry of all metrics of a webapp process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter(
+            'requests_total', 'Number of handled requests.',
+            ('endpoint', 'method', 'status'))
+        self.latency = Histogram(
+            'request_duration_seconds',
+            'Time until a response (or the start of a streamed response) '
+            'was ready.',
+            ('endpoint', 'method'))
+        self.bytes_in = Counter(
+            'request_bytes_total', 'Size of request bodies.',
+            ('endpoint',))
+        self.bytes_out = Counter(
+            'response_bytes_total', 'Size of response bodies.',
+            ('endpoint',))
+        self.datalad_calls = Histogram(
+            'datalad_call_duration_seconds',
+            'Time spent in calls of DataLad commands.',
+            ('command',))
+        self.transfers = Counter(
+            'content_transfers_total',
+            'Number of files whose content was actually retrieved.')
+
+    def observe_request(self, endpoint, method, status, duration,
+                        bytes_in):
+        with self._lock:
+            self.requests.inc((endpoint, method, status))
+            self.latency.observe(duration, (endpoint, method))
+            if bytes_in:
+                self.bytes_in.inc((endpoint,), bytes_in)
+
+    def count_bytes_out(self, endpoint, nbytes):
+        with self._lock:
+            self.bytes_out.inc((endpoint,), nbytes)
+
+    def count_transfers(self, results):
+        """Count files whose content was retrieved according to `get`
+        results, and pass the results on"""
+        n = sum(
+            1 for r in results
+            if r.get('action') == 'get' and r.get('type') == 'file'
+            and r.get('status') == 'ok')
+        if n:
+            with self._lock:
+                self.transfers.inc(value=n)
+        return results
+
+    @contextmanager
+    def time_datalad_call(self, command):
+        """Context manager to record the duration of a DataLad command"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - t0
+            with self._lock:
+                self.datalad_calls.observe(duration, (command,))
+
+    def expose(self):
+        """Return all metrics in Prometheus text exposition format"""
+        with self._lock:
+            lines = []
+            for m in (self.requests, self.latency, self.bytes_in,
+                      self.bytes_out, self.datalad_calls, self.transfers):
+                lines.extend(m.expose())
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of this process
+metrics = Metrics()
+
+
+def _count_iter(chunks, endpoint):
+    nbytes = 0
+    try:
+        for chunk in chunks:
+            nbytes += len(chunk)
+            yield chunk
+    finally:
+        metrics.count_bytes_out(endpoint, nbytes)
+
+
+def init_app(app):
+    """Record metrics of all requests to a Flask app
+
+    Metrics are exposed at '/metrics' (authentication required).
+    """
+    from flask import (
+        g,
+        request,
+    )
+    from datalad_webapp import verify_authentication
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(rv):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return rv
+        endpoint = request.endpoint or 'none'
+        metrics.observe_request(
+            endpoint,
+            request.method,
+            rv.status_code,
+            time.perf_counter() - start,
+            request.content_length,
+        )
+        if rv.is_streamed:
+            rv.response = _count_iter(rv.response, endpoint)
+        else:
+            metrics.count_bytes_out(endpoint, rv.calculate_content_length())
+        return rv
+
+    @app.route('/metrics')
+    @verify_authentication
+    def serve_metrics():
+        return app.response_class(
+            metrics.expose(),
+            mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,233 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""State of served datasets, shared by all requests"""
+
+__docformat__ = 'restructuredtext'
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import logging
+lgr = logging.getLogger('datalad.webapp.pool')
+
+
+class DatasetState(object):
+    """Everything the resources keep for a single dataset
+
+    Parameters
+    ----------
+    dataset : Dataset
+    """
+    def __init__(self, dataset):
+        from datalad_webapp.batch import BatchedRepo
+        from datalad_webapp.cache import ResultCache
+        from datalad_webapp.fileindex import FileIndex
+        from datalad_webapp.transfer import TransferScheduler
+        from datalad_webapp.writer import (
+            WriteBehindQueue,
+            WriteScheduler,
+        )
+        self.dataset = dataset
+        self.fileindex = FileIndex(dataset)
+        # build upfront, rather than on the first request
+        self.fileindex.files
+        self.batch = BatchedRepo(dataset)
+        self.transfers = TransferScheduler(
+            dataset, max_workers=self.batch.get_size, batch=self.batch)
+        self.cache = ResultCache(dataset)
+        self.writer = WriteScheduler(dataset, fileindex=self.fileindex)
+        self.writequeue = WriteBehindQueue(
+            dataset, fileindex=self.fileindex, writer=self.writer)
+        # number of requests using this state
+        self.users = 0
+        self.last_used = time.time()
+
+    def as_kwargs(self):
+        """Return the state as keyword arguments for `WebAppResource`"""
+        return dict(
+            dataset=self.dataset,
+            fileindex=self.fileindex,
+            transfers=self.transfers,
+            cache=self.cache,
+            writequeue=self.writequeue,
+            batch=self.batch,
+            writer=self.writer,
+        )
+
+    @property
+    def idle(self):
+        """Whether nothing is using, or still to be done with the state"""
+        return not self.users \
+            and self.writer.idle \
+            and not self.writequeue.pending \
+            and self.transfers.idle
+
+    def close(self):
+        """Save pending modifications, and stop all threads and processes"""
+        self.writequeue.close()
+        self.writer.close()
+        self.transfers.shutdown(wait=False)
+        self.batch.close()
+
+
+class DatasetPool(object):
+    """Lazily set up `DatasetState` for any number of datasets
+
+    Only the state of up to `max_active` datasets is kept. When more are
+    in use, the state of the least recently used idle dataset is dropped.
+
+    Parameters
+    ----------
+    paths : dict
+      Paths of the datasets, by dataset ID.
+    max_active : int
+    """
+    def __init__(self, paths, max_active=8):
+        self.paths = OrderedDict(paths)
+        self.max_active = max_active
+        self._lock = threading.Lock()
+        # most recently used last
+        self._states = OrderedDict()
+        # futures of states being set up, by dataset ID
+        self._setups = {}
+
+    @property
+    def active(self):
+        """IDs of datasets whose state is kept"""
+        with self._lock:
+            return list(self._states)
+
+    def acquire(self, dataset_id):
+        """Return the state of a dataset, and mark it as being used
+
+        Each call must be matched by a call of `release()`. The state of a
+        dataset is set up outside the pool lock, requests for other
+        datasets are not held up meanwhile.
+
+        Returns
+        -------
+        DatasetState or None
+          None, if there is no dataset with this ID.
+        """
+        if dataset_id not in self.paths:
+            return None
+        while True:
+            with self._lock:
+                state = self._states.get(dataset_id)
+                if state is not None:
+                    evicted = self._use(dataset_id, state)
+                    break
+                setup = self._setups.get(dataset_id)
+                if setup is None:
+                    setup = self._setups[dataset_id] = Future()
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                # set up by another request, raises if that failed
+                setup.result()
+                continue
+            try:
+                state = self._setup(dataset_id)
+            except BaseException as e:
+                with self._lock:
+                    del self._setups[dataset_id]
+                setup.set_exception(e)
+                raise
+            with self._lock:
+                del self._setups[dataset_id]
+                self._states[dataset_id] = state
+                evicted = self._use(dataset_id, state)
+            setup.set_result(state)
+            break
+        for s in evicted:
+            s.close()
+        return state
+
+    def _setup(self, dataset_id):
+        from datalad.distribution.dataset import require_dataset
+        t0 = time.time()
+        state = DatasetState(require_dataset(
+            self.paths[dataset_id],
+            check_installed=True,
+            purpose='serving'))
+        lgr.debug('Set up dataset %s in %.3fs',
+                  dataset_id, time.time() - t0)
+        return state
+
+    def _use(self, dataset_id, state):
+        # caller holds the lock
+        self._states.move_to_end(dataset_id)
+        state.users += 1
+        state.last_used = time.time()
+        return self._evict()
+
+    def release(self, state):
+        with self._lock:
+            state.users -= 1
+
+    def _evict(self):
+        # caller holds the lock
+        evicted = []
+        for dataset_id, state in list(self._states.items()):
+            if len(self._states) <= self.max_active:
+                break
+            if state.idle:
+                lgr.debug('Dropping state of idle dataset %s', dataset_id)
+                evicted.append(self._states.pop(dataset_id))
+        return evicted
+
+    def close(self):
+        with self._lock:
+            states = list(self._states.values())
+            self._states.clear()
+        for state in states:
+            state.close()
+
+    def init_app(self, app):
+        """Route '/api/v1/<dataset_id>/...' requests to the datasets
+
+        The dataset ID is taken out of the view arguments of a request, and
+        is available as `flask.g.dataset_id`. URLs built with `url_for()`
+        refer to the dataset of the current request. All dataset IDs are
+        listed at '/api/v1/datasets'.
+        """
+        from flask import g
+        from datalad_webapp import verify_authentication
+        from datalad_webapp.jsonprovider import jsonify
+
+        @app.url_value_preprocessor
+        def pop_dataset_id(endpoint, values):
+            if values and 'dataset_id' in values:
+                g.dataset_id = values.pop('dataset_id')
+
+        @app.url_defaults
+        def add_dataset_id(endpoint, values):
+            if 'dataset_id' not in values and g.get('dataset_id') \
+                    and app.url_map.is_endpoint_expecting(
+                        endpoint, 'dataset_id'):
+                values['dataset_id'] = g.dataset_id
+
+        @app.teardown_request
+        def release_dataset(exc):
+            state = g.pop('dataset_state', None)
+            if state is not None:
+                self.release(state)
+
+        @app.route('/api/v1/datasets')
+        @verify_authentication
+        def list_datasets():
+            active = self.active
+            return jsonify({'datasets': [
+                {'id': dataset_id,
+                 'path': path,
+                 'active': dataset_id in active}
+                for dataset_id, path in self.paths.items()]})
@@ -0,0 +1,277 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Opt-in profiling of individual requests"""
+
+__docformat__ = 'restructuredtext'
+
+import cProfile
+import itertools
+import os
+from contextlib import contextmanager
+import os.path as op
+import pstats
+import tempfile
+import time
+
+import logging
+lgr = logging.getLogger('datalad.webapp.profiling')
+
+# request header to ask for a profile of a request (requires an API key)
+profile_header = 'X-Datalad-Profile'
+
+# maximum number of saved profiles per directory, the oldest are removed
+max_profiles = 1000
+# distinguishes profiles of requests made within the same second
+_profile_counter = itertools.count()
+
+# code that runs or waits for external processes
+_subprocess_modules = (
+    '/subprocess.py',
+    '/datalad/runner/',
+    '/datalad/cmd.py',
+)
+
+
+def _is_subprocess_code(filename):
+    filename = filename.replace(os.sep, '/')
+    return any(
+        m in filename if m.endswith('/') else filename.endswith(m)
+        for m in _subprocess_modules)
+
+
+def summarize(stats):
+    """Summarize a profile
+
+    Parameters
+    ----------
+    stats : pstats.Stats
+
+    Returns
+    -------
+    dict
+      'total': profiled time; 'subprocess': time spent running (and
+      waiting for) external processes, like git and git-annex;
+      'processes': number of started processes (all times in seconds).
+    """
+    subprocess_time = 0.0
+    processes = 0
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not _is_subprocess_code(func[0]):
+            continue
+        if func[2] == '_execute_child':
+            processes += nc
+        # only count calls from outside, nested calls are included in them
+        subprocess_time += sum(
+            edge[3] for caller, edge in callers.items()
+            if not _is_subprocess_code(caller[0]))
+    return dict(
+        total=stats.total_tt,
+        subprocess=subprocess_time,
+        processes=processes,
+    )
+
+
+def get_request_profiles():
+    """Return where profiles of work done for the current request go
+
+    Returns
+    -------
+    list or None
+      None, if the current request is not profiled (or there is none).
+      Otherwise a list, to append `cProfile.Profile` instances of work done
+      on other threads to (see `profile_into()`).
+    """
+    from flask import (
+        g,
+        has_app_context,
+    )
+    if not has_app_context():
+        return None
+    return g.get('worker_profiles')
+
+
+@contextmanager
+def profile_into(targets):
+    """Profile a block of code done on behalf of profiled requests
+
+    Parameters
+    ----------
+    targets : list
+      Values of `get_request_profiles()` of the requests, None values are
+      ignored. The profile is added to all of them. Without any target,
+      nothing is profiled.
+    """
+    targets = [t for t in targets if t is not None]
+    if not targets:
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is active (PY >= 3.12), it covers all threads
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        for t in targets:
+            t.append(profiler)
+
+
+def profiled(func):
+    """Wrap a callable that is run on another thread for the current request
+
+    If the request is profiled, so is the call, see `profile_into()`.
+    """
+    target = get_request_profiles()
+    if target is None:
+        return func
+
+    def wrapped(*args, **kwargs):
+        with profile_into([target]):
+            return func(*args, **kwargs)
+    return wrapped
+
+
+def get_profile_dir(dataset=None):
+    """Return the directory that holds saved request profiles"""
+    profile_dir = op.join(
+        str(dataset.repo.dot_git) if dataset is not None
+        else tempfile.gettempdir(),
+        'datalad_webapp', 'profiles')
+    if not op.exists(profile_dir):
+        os.makedirs(profile_dir)
+    return profile_dir
+
+
+def get_profile_filename(profile_dir, method, name):
+    """Return a new, unique file name for a request profile
+
+    Names sort in the order the profiles were made (per process).
+    """
+    return op.join(
+        profile_dir,
+        '{}-{}-{:06d}-{}-{}.prof'.format(
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            next(_profile_counter) % 1000000, method, name))
+
+
+def prune_profiles(profile_dir, keep=None):
+    """Remove the oldest profiles, keeping at most `keep` (`max_profiles`)"""
+    keep = max_profiles if keep is None else keep
+    profiles = sorted(
+        f for f in os.listdir(profile_dir) if f.endswith('.prof'))
+    for f in profiles[:max(0, len(profiles) - keep)]:
+        try:
+            os.unlink(op.join(profile_dir, f))
+        except OSError:
+            # removed concurrently
+            pass
+
+
+def init_app(app, dataset=None, always=False):
+    """Enable profiling of requests to a Flask app
+
+    Requests are profiled when they carry an `X-Datalad-Profile` header
+    and a valid API key, or all requests with `always`. The profile of a
+    request is saved (in `pstats` format) to the directory given by
+    `get_profile_dir()`, and a summary is returned in a `Server-Timing`
+    header. For streamed responses, profiling ends when the response body
+    is sent, and there is no summary header.
+
+    Work done on other threads for a profiled request, like saving or
+    retrieving content, is included in the saved profile, and in the
+    reported subprocess time (see `profiled()`), if it is done before the
+    response is sent. The reported total is the time of the request itself.
+
+    Without a `dataset`, profiles are saved for the dataset of the request
+    (see `DatasetPool`), or in a temporary directory. Only the most recent
+    `max_profiles` profiles are kept.
+    """
+    from flask import (
+        g,
+        request,
+    )
+    from datalad_webapp import (
+        get_request_api_key,
+        is_valid_api_key,
+    )
+
+    def _save(profiler, info):
+        # no request context here, streamed responses outlive it
+        method, path, name, ds, worker_profiles = info
+        stats = pstats.Stats(profiler)
+        total = stats.total_tt
+        # copy, workers may still add to it
+        for p in list(worker_profiles):
+            stats.add(p)
+        summary = summarize(stats)
+        # waiting for the workers is part of the request already
+        summary['total'] = total
+        profile_dir = get_profile_dir(ds)
+        filename = get_profile_filename(profile_dir, method, name)
+        stats.dump_stats(filename)
+        prune_profiles(profile_dir)
+        lgr.info(
+            '%s %s took %.3fs (%.3fs in %i external processes), '
+            'profile saved to %s',
+            method, path, summary['total'],
+            summary['subprocess'], summary['processes'], filename)
+        return summary
+
+    def _profile_iter(profiler, chunks, info):
+        try:
+            profiler.enable()
+            for chunk in chunks:
+                yield chunk
+        finally:
+            profiler.disable()
+            _save(profiler, info)
+
+    @app.before_request
+    def start_profile():
+        if not always and not (
+                profile_header in request.headers
+                and is_valid_api_key(get_request_api_key())):
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # another profiler is active (PY >= 3.12)
+            lgr.warning('Cannot profile %s: %s', request.path, e)
+            return
+        g.profiler = profiler
+        g.worker_profiles = []
+
+    @app.after_request
+    def stop_profile(rv):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return rv
+        profiler.disable()
+        ds = dataset
+        if ds is None and g.get('dataset_state') is not None:
+            ds = g.dataset_state.dataset
+        info = (request.method, request.path, request.endpoint or 'none', ds,
+                g.pop('worker_profiles', []))
+        if rv.is_streamed:
+            rv.response = _profile_iter(profiler, rv.response, info)
+            return rv
+        summary = _save(profiler, info)
+        rv.headers.add(
+            'Server-Timing',
+            'total;dur={:.1f}, subprocess;dur={:.1f};desc="{} processes"'
+            .format(
+                summary['total'] * 1000,
+                summary['subprocess'] * 1000,
+                summary['processes']))
+        return rv
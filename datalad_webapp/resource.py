@@ -1,7 +1,54 @@
+from flask import (
+    abort,
+    g,
+)
 from flask_restful import Resource
 
 
 class WebAppResource(Resource):
-    def __init__(self, dataset, read_only=False):
-        self.ds = dataset
+    # attributes taken from the `DatasetState` of the requested dataset,
+    # when serving multiple datasets
+    _state_attrs = {
+        'ds': 'dataset',
+        'fileindex': 'fileindex',
+        'transfers': 'transfers',
+        'cache': 'cache',
+        'writequeue': 'writequeue',
+        'batch': 'batch',
+        'writer': 'writer',
+    }
+
+    def __init__(self, dataset=None, read_only=False, fileindex=None,
+                 transfers=None, cache=None, writequeue=None, batch=None,
+                 writer=None, pool=None):
         self.read_only = read_only
+        self._pool = pool
+        if pool is not None:
+            # the state is only acquired on first use, i.e. after the
+            # request was authenticated (see __getattr__)
+            return
+        self.ds = dataset
+        self.fileindex = fileindex
+        self.transfers = transfers
+        self.cache = cache
+        self.writequeue = writequeue
+        self.batch = batch
+        self.writer = writer
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set, i.e. for the state
+        # of the requested dataset when serving multiple datasets
+        attr = self._state_attrs.get(name)
+        pool = self.__dict__.get('_pool')
+        if attr is None or pool is None:
+            raise AttributeError(name)
+        state = g.get('dataset_state')
+        if state is None:
+            state = pool.acquire(g.get('dataset_id'))
+            if state is None:
+                abort(404)
+            # released at the end of the request
+            g.dataset_state = state
+        for k, a in self._state_attrs.items():
+            setattr(self, k, getattr(state, a))
+        return getattr(self, name)
@@ -1,19 +1,24 @@
 from flask import session
-from flask import jsonify
 from datalad_webapp import (
-    webapp_props,
+    get_request_api_key,
     verify_authentication,
 )
+from datalad_webapp.jsonprovider import jsonify
 from datalad_webapp.resource import WebAppResource
 
 
 class AuthenticationResource(WebAppResource):
-    # TODO protect with httpauth
+    """Session for clients that cannot send a key with every request
+
+    A valid API key must be presented (see `get_request_api_key()`) to
+    obtain the session. The key itself is never reported.
+    """
+    @verify_authentication
     def get(self):
-        if 'config' not in webapp_props:
-            raise ValueError('No running webapp')
-        session['api_key'] = webapp_props['config']['api_key']
-        return jsonify({'api_key': session['api_key']})
+        session['api_key'] = get_request_api_key()
+        return jsonify({
+            'message': 'authenticated',
+        })
 
     @verify_authentication
     def delete(self):
@@ -0,0 +1,15 @@
+from datalad_webapp import verify_authentication
+from datalad_webapp.jsonprovider import jsonify
+from datalad_webapp.resource import WebAppResource
+
+
+class CacheResource(WebAppResource):
+    """Statistics and control of the command result cache"""
+    @verify_authentication
+    def get(self):
+        return jsonify(self.cache.stats)
+
+    @verify_authentication
+    def delete(self):
+        self.cache.clear()
+        return jsonify(self.cache.stats)
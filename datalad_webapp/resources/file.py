@@ -1,81 +1,233 @@
 from flask import (
     abort,
-    jsonify,
+    request,
+    url_for,
 )
 from flask_restful import (
     reqparse,
 )
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import os
 import os.path as op
-from fnmatch import fnmatch
-
-from datalad.api import (
-    get,
-    remove,
-)
+from werkzeug.http import parse_content_range_header
 
 from datalad_webapp import verify_authentication
+from datalad_webapp.content import (
+    get_annex_key,
+    get_blob_sha,
+    has_local_content,
+    iter_json_stream,
+    json_array_response,
+    ndjson_response,
+    send_content,
+)
+from datalad_webapp.httpcache import (
+    get_commit_time,
+    make_etag,
+    not_modified,
+    set_cache_headers,
+)
+from datalad_webapp.jsonprovider import jsonify
+from datalad_webapp.metrics import metrics
 from datalad_webapp.resource import WebAppResource
+from datalad_webapp.writer import (
+    DecodingError,
+    FileChange,
+    WriteQueueFull,
+    get_partial_upload,
+    receive_stream,
+)
 from datalad.support import json_py
 from datalad.support.constraints import (
     EnsureBool,
     EnsureChoice,
+    EnsureInt,
+    EnsureRange,
 )
 import logging
 lgr = logging.getLogger('datalad.webapp.resources.file')
 
+# explanations of path validation failures
+_path_error_msgs = {
+    403: 'path is outside the dataset',
+    404: 'no such file',
+    422: 'path is a directory',
+}
+# content that is not present cannot be retrieved in read-only mode
+_no_content_msg = 'file content is not available locally'
+
+
+def _format_result_message(msg):
+    # datalad result messages can be (format, *args) tuples
+    if isinstance(msg, tuple):
+        return msg[0] % msg[1:]
+    return msg
+
+
+# how to interpret file content
+_json_type = EnsureChoice('yes', 'no', 'stream')
+# flags, of a request and of the individual changes of a PATCH request
+_bool_type = EnsureBool()
+# seconds a request waits for its queued write to complete
+write_timeout = 600
+
+
+def _remove_upload(path):
+    # content received for a write that failed
+    if path is not None and op.lexists(path):
+        os.unlink(path)
+
+
+def _get_parser():
+    limit_type = EnsureInt() & EnsureRange(min=1)
+    offset_type = EnsureInt() & EnsureRange(min=0)
+    rp = reqparse.RequestParser()
+    rp.add_argument(
+        'path', type=str,
+        help="""path to file. If none is given, or the path contains a
+        wildcard character '*', a list of (matching) files in the
+        dataset is returned.""",
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'json', type=_json_type,
+        default='no',
+        help='%s. {error_msg}' % repr(_json_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'raw', type=_bool_type,
+        default=False,
+        help="""flag whether to stream the file content as-is, instead
+        of returning it as part of a JSON response. Binary content is
+        supported, as well as HTTP range requests. In combination with
+        json=stream, records are streamed as newline-delimited JSON.
+        %s. {error_msg}"""
+        % repr(_bool_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'wait', type=_bool_type,
+        default=True,
+        help="""flag whether to wait for file content to be retrieved.
+        If disabled, and the content is not yet available, the
+        retrieval continues in the background, and a 202 (Accepted)
+        response with the status of the retrieval job is returned.
+        %s. {error_msg}""" % repr(_bool_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'verify_availability', type=_bool_type,
+        default='yes',
+        help='%s. {error_msg}' % repr(_bool_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'limit', type=limit_type,
+        help="""maximum number of files to report in a file list. If
+        given, the response contains a 'next' cursor for requesting the
+        next batch of files, or null if there are no more files.
+        With json=stream, the maximum number of records to report.
+        %s. {error_msg}""" % repr(limit_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'offset', type=offset_type,
+        default=0,
+        help="""number of records to skip with json=stream.
+        %s. {error_msg}""" % repr(offset_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'fields', type=str,
+        help="""comma-separated list of record fields to report with
+        json=stream. By default all fields are reported.""",
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'keys', type=_bool_type,
+        default=False,
+        help="""flag whether to report the annex key, or the git blob
+        SHA of each file in a file list, as a 'keys' mapping of paths to
+        keys. Content can be requested by key from the 'object'
+        resource. %s. {error_msg}""" % repr(_bool_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'paths', type=str,
+        action='append',
+        help="""paths of files to read in a single request (POST).
+        Can be combined with 'path', which may contain wildcards.""",
+        location=['json', 'form', 'args'])
+    rp.add_argument(
+        'cursor', type=str,
+        help="""only report files in a file list that come after this
+        cursor, as reported by a previous (limited) request.""",
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'content',
+        help='file content',
+        location=['form', 'json'])
+    rp.add_argument(
+        'togit', type=_bool_type,
+        help="""flag whether to add files to git, instead of making a
+        decision based on the dataset configuration. %s. {error_msg}"""
+        % repr(_bool_type),
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'changes', type=dict,
+        action='append',
+        help="""list of file modifications to apply in a single commit
+        (PATCH). Each modification is a mapping with a 'path', and
+        either 'content' (and optionally 'json'), or 'delete': true.""",
+        location=['json'])
+    rp.add_argument(
+        'message', type=str,
+        help="""commit message.""",
+        location=['args', 'json', 'form'])
+    rp.add_argument(
+        'defer', type=_bool_type,
+        default=False,
+        help="""flag whether to queue file modifications (PATCH), to be
+        saved together with other queued modifications once enough
+        have been collected, or after a short delay. %s. {error_msg}"""
+        % repr(_bool_type),
+        location=['args', 'json', 'form'])
+    return rp
+
 
 class FileResource(WebAppResource):
     # any arg is treated as a relative path
     _urlarg_spec = '<path:path>'
 
-    def __init__(self, *args, **kwargs):
-        super(FileResource, self).__init__(*args, **kwargs)
-        # setup parser
-        bool_type = EnsureBool()
-        json_type = EnsureChoice('yes', 'no', 'stream')
-        self.rp = reqparse.RequestParser()
-        self.rp.add_argument(
-            'path', type=str,
-            help="""path to file. If none is given, or the path contains a
-            wildcard character '*', a list of (matching) files in the
-            dataset is returned.""",
-            location=['args', 'json', 'form'])
-        self.rp.add_argument(
-            'json', type=json_type,
-            default='no',
-            help='%s. {error_msg}' % repr(json_type),
-            location=['args', 'json', 'form'])
-        self.rp.add_argument(
-            'verify_availability', type=bool_type,
-            default='yes',
-            help='%s. {error_msg}' % repr(bool_type),
-            location=['args', 'json', 'form'])
-        self.rp.add_argument(
-            'content',
-            help='file content',
-            location=['form', 'json'])
-        self.rp.add_argument(
-            'togit', type=bool_type,
-            help="""flag whether to add files to git, instead of making a
-            decision based on the dataset configuration. %s. {error_msg}"""
-            % repr(bool_type),
-            location=['json', 'form'])
-        # TODO message argument for commits
+    # request parser, built once
+    rp = _get_parser()
 
-    def _validate_file_path(self, path, fail_nonexistent=True):
-        file_abspath = op.join(self.ds.path, path)
+    def _get_path_error(self, file_abspath, fail_nonexistent=True):
+        # returns the HTTP status code for an invalid path, or None
         if op.relpath(file_abspath, self.ds.path).startswith(op.pardir):
             # XXX not sure if this can actually happen
             # something funky is going on -> forbidden
-            abort(403)
-        if fail_nonexistent and not op.exists(file_abspath):
-            abort(404)
+            return 403
+        # lexists: annexed files without content are broken symlinks
+        if fail_nonexistent and not op.lexists(file_abspath):
+            return 404
         if op.exists(file_abspath) and op.isdir(file_abspath):
             # -> rejected due to semantic error: dir != file
-            abort(422)
+            return 422
+        return None
+
+    def _validate_file_path(self, path, fail_nonexistent=True):
+        file_abspath = op.join(self.ds.path, path)
+        error = self._get_path_error(file_abspath, fail_nonexistent)
+        if error:
+            abort(error)
         return file_abspath
 
+    def _read_content(self, file_abspath, json_mode):
+        # TODO proper error reporting when loading/decoding fails
+        if json_mode == 'stream':
+            return list(json_py.load_stream(file_abspath))
+        elif json_mode == 'yes':
+            return json_py.load(file_abspath)
+        with open(file_abspath, 'r') as f:
+            return f.read()
+
+    def _get_relpath(self, file_abspath):
+        # path as reported by the file index
+        return op.relpath(file_abspath, self.ds.path).replace(op.sep, '/')
+
     @verify_authentication
     def get(self, path=None):
         args = self.rp.parse_args()
@@ -84,62 +236,334 @@ class FileResource(WebAppResource):
         if path is None or '*' in path:
             path = path if path else '*'
             # no path, give list of available files
-            return jsonify({
-                'files': [f for f in self.ds.repo.get_indexed_files()
-                          if fnmatch(f, path)],
-            })
+            head, stamp = self.fileindex.version
+            # the arguments may come in the body, not just the URL
+            etag = make_etag(
+                head, stamp, path, args.cursor, args.limit, args['keys'])
+            last_modified = get_commit_time(self.batch, head)
+            rv = not_modified(etag, last_modified)
+            if rv is not None:
+                return rv
+            if args.limit is None:
+                files = self.fileindex.glob(path, start_after=args.cursor)
+                res = {'files': files}
+            else:
+                # ask for one more to learn whether there is another batch
+                files = self.fileindex.glob(
+                    path, start_after=args.cursor, limit=args.limit + 1)
+                res = {
+                    'files': files[:args.limit],
+                    'next': files[args.limit - 1]
+                    if len(files) > args.limit else None,
+                }
+            # not args.keys, that is the dict method
+            if args['keys']:
+                keys = self.fileindex.keys
+                res['keys'] = {f: keys.get(f) for f in res['files']}
+            return set_cache_headers(jsonify(res), etag, last_modified)
 
         file_abspath = self._validate_file_path(path)
-        if not self.read_only:
-            # in read only mode we cannot do this, as it might cause
-            # more datasets to be install etc...
-            self.ds.get(file_abspath)
-        # TODO proper error reporting when loading/decoding fails
+        # the key of an annexed file is known without its content, answer
+        # a conditional request before retrieving it. Locked files name
+        # it in their symlink, others are looked up (None if not annexed)
+        etag = get_annex_key(file_abspath) or (
+            None if op.islink(file_abspath)
+            else self.batch.lookupkey(file_abspath))
+        if etag:
+            rv = not_modified(etag)
+            if rv is not None:
+                return rv
+        if not has_local_content(file_abspath):
+            if self.read_only:
+                # in read only mode we cannot retrieve it, as it might
+                # cause more datasets to be install etc...
+                abort(404, _no_content_msg)
+            job = self.transfers.submit(file_abspath)
+            if not args.wait and not job.future.done():
+                rv = jsonify(job.as_dict())
+                rv.status_code = 202
+                rv.headers['Location'] = url_for(
+                    'jobresource', job_id=job.id)
+                return rv
+            job.result()
+        if not etag:
+            # in git, cached, the content is only read when it changed
+            etag = get_blob_sha(file_abspath)
+            rv = not_modified(etag)
+            if rv is not None:
+                return rv
+        if args.raw and args.json != 'stream':
+            return send_content(file_abspath, etag=etag)
         if args.json == 'stream':
-            content = list(json_py.load_stream(file_abspath))
-        elif args.json == 'yes':
-            content = json_py.load(file_abspath)
+            # a record that cannot be decoded ends the response with an
+            # error, see ndjson_response() and json_array_response()
+            records = iter_json_stream(
+                file_abspath,
+                offset=args.offset,
+                limit=args.limit,
+                fields=args.fields.split(',') if args.fields else None,
+            )
+            if args.raw:
+                rv = ndjson_response(records)
+            else:
+                rv = json_array_response(records, 'content', {'path': path})
         else:
-            content = open(file_abspath, 'r').read()
+            rv = jsonify({
+                'path': path,
+                'content': self._read_content(file_abspath, args.json),
+            })
+        return set_cache_headers(
+            rv, etag, int(os.stat(file_abspath).st_mtime))
 
-        return jsonify({
-            'path': path,
-            'content': content,
-        })
+    @verify_authentication
+    def post(self, path=None):
+        """Read the content of multiple files in a single request
+
+        Files are selected by a list of 'paths' and/or a 'path' pattern.
+        Any missing content is retrieved with a single `get` call. The
+        response is a stream of newline-delimited JSON records, one per
+        file, with either the file 'content' or an 'error' message.
+        """
+        args = self.rp.parse_args()
+        path = path or args.path
+        paths = list(args.paths or [])
+        if path and '*' in path:
+            paths.extend(self.fileindex.glob(
+                path, start_after=args.cursor, limit=args.limit))
+        elif path:
+            paths.append(path)
+        if not paths:
+            # BadRequest
+            abort(400)
+
+        files = {}
+        errors = {}
+        for p in paths:
+            file_abspath = op.join(self.ds.path, p)
+            error = self._get_path_error(file_abspath)
+            if error:
+                errors[p] = _path_error_msgs[error]
+            else:
+                files[p] = file_abspath
+
+        missing = [f for f in files.values() if not has_local_content(f)]
+        if missing and self.read_only:
+            for p, f in files.items():
+                if f in missing:
+                    errors[p] = _no_content_msg
+        elif missing:
+            # ensure bound dataset method
+            import datalad.distribution.get
+            with metrics.time_datalad_call('get'):
+                results = metrics.count_transfers(self.ds.get(
+                    missing, on_failure='ignore', return_type='list'))
+            for res in results:
+                if res.get('type') == 'file' \
+                        and res.get('status') in ('impossible', 'error'):
+                    errors[self._get_relpath(res['path'])] = \
+                        _format_result_message(res.get('message')) \
+                        or 'content retrieval failed'
+
+        def gen():
+            for p in paths:
+                if p in errors:
+                    yield {'path': p, 'error': errors[p]}
+                    continue
+                try:
+                    content = self._read_content(files[p], args.json)
+                except Exception as e:
+                    yield {'path': p, 'error': str(e)}
+                    continue
+                yield {'path': p, 'content': content}
+
+        return ndjson_response(gen())
 
-    # TODO support compression
     @verify_authentication
     def put(self, path=None):
+        """Write a file
+
+        Content can be given as a 'content' argument (form or JSON), as an
+        uploaded file named 'content' (multipart form), or as the raw
+        request body (any other content type). Uploaded files and raw
+        bodies are written to disk in chunks, and may be compressed
+        (Content-Encoding gzip or zstd). A raw body can be sent in multiple
+        requests, each with a Content-Range header. A request with
+        Content-Range 'bytes */<total>' and no body reports how much was
+        received so far, to resume an interrupted upload.
+        """
         if self.read_only:
             abort(403)
         args = self.rp.parse_args()
         path = path or args.path
-        if path is None or args.content is None:
+        if path is None:
             # BadRequest
             abort(400)
         file_abspath = self._validate_file_path(
             path, fail_nonexistent=False)
-        # TODO handle failure without crashing
-        if op.exists(file_abspath):
-            self.ds.repo.remove(file_abspath)
-        # TODO git checkout of that removed files, when
-        # below fails
-        # TODO support file uploads
-        dirname = op.dirname(file_abspath)
-        if not op.exists(dirname):
-            os.makedirs(dirname)
-        if args.json == 'stream':
-            json_py.dump2stream(
-                json_py.loads(args.content), file_abspath)
-        elif args.json == 'yes':
-            json_py.dump(
-                json_py.loads(args.content), file_abspath)
+        relpath = self._get_relpath(file_abspath)
+        # content received in this request only, to be removed if it
+        # cannot be written. A resumable upload is kept for another try
+        upload = None
+        if 'content' in request.files:
+            source = upload = self._receive(request.files['content'].stream)
+        elif request.mimetype not in (
+                'application/json',
+                'application/x-www-form-urlencoded',
+                'multipart/form-data') and (
+                    request.content_length
+                    or 'Content-Range' in request.headers
+                    or request.headers.get('Transfer-Encoding') == 'chunked'):
+            source = self._receive_raw(relpath)
+            if not isinstance(source, str):
+                # not complete yet
+                return source
+            if 'Content-Range' not in request.headers:
+                upload = source
+        elif args.content is None:
+            # BadRequest
+            abort(400)
         else:
-            open(file_abspath, 'w').write(args.content)
-        self.ds.save(
-            file_abspath,
+            source = None
+        change = FileChange(
+            relpath,
+            content=args.content,
+            json=args.json,
+            source=source)
+        try:
+            self._validate_change(change)
+            future = self._submit(
+                self.writer.submit_changes,
+                [change],
+                message=args.message,
+                to_git=args.togit,
+            )
+        except BaseException:
+            _remove_upload(upload)
+            raise
+        if upload is not None:
+            # also if the save fails after this request gave up waiting
+            future.add_done_callback(
+                lambda f: f.exception() and _remove_upload(upload))
+        self._wait(future)
+
+    def _validate_change(self, change):
+        # reject invalid content before anything is queued or written
+        try:
+            change.validate()
+        except ValueError as e:
+            abort(400, str(e))
+
+    def _submit(self, submit, *args, **kwargs):
+        # ask the client to come back later, if too many writes are pending
+        try:
+            return submit(*args, **kwargs)
+        except WriteQueueFull as e:
+            rv = jsonify({'message': str(e)})
+            rv.status_code = 503
+            rv.headers['Retry-After'] = str(e.retry_after)
+            abort(rv)
+
+    def _write(self, submit, *args, **kwargs):
+        # all modifications go through the single writer of the dataset
+        return self._wait(self._submit(submit, *args, **kwargs))
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=write_timeout)
+        except FutureTimeoutError:
+            # still queued, or running
+            abort(503, 'write did not complete within {}s'.format(
+                write_timeout))
+
+    def _receive(self, stream, target=None):
+        try:
+            return receive_stream(
+                self.ds,
+                stream,
+                encoding=request.headers.get('Content-Encoding'),
+                target=target)
+        except ValueError:
+            # unsupported content encoding
+            abort(415)
+        except DecodingError as e:
+            abort(400, str(e))
+
+    def _receive_raw(self, relpath):
+        # returns the path of the received file once complete, or
+        # a response that reports the status of a partial upload
+        crange = request.headers.get('Content-Range')
+        if crange is None:
+            return self._receive(request.stream)
+        crange = parse_content_range_header(crange)
+        if crange is None or crange.length is None:
+            abort(400)
+        partial = get_partial_upload(self.ds, relpath)
+        received = op.getsize(partial) if op.exists(partial) else 0
+        if crange.start is not None:
+            if crange.start != received:
+                # client and server disagree, client must resume
+                return self._upload_status(received, crange.length, 409)
+            self._receive(request.stream, target=partial)
+            received = op.getsize(partial)
+        if received > crange.length:
+            os.unlink(partial)
+            abort(400)
+        elif received < crange.length:
+            return self._upload_status(received, crange.length, 202)
+        return partial
+
+    def _upload_status(self, received, total, status):
+        rv = jsonify({'received': received, 'total': total})
+        rv.status_code = status
+        if received:
+            rv.headers['Range'] = 'bytes=0-{}'.format(received - 1)
+        return rv
+
+    @verify_authentication
+    def patch(self, path=None):
+        """Apply modifications of multiple files in a single commit"""
+        if self.read_only:
+            abort(403)
+        args = self.rp.parse_args()
+        if not args.changes:
+            # BadRequest
+            abort(400)
+        changes = []
+        for spec in args.changes:
+            try:
+                delete = _bool_type(spec.get('delete', False))
+                json_mode = _json_type(spec.get('json', 'no'))
+            except ValueError:
+                abort(400)
+            if not spec.get('path') \
+                    or (not delete and spec.get('content') is None):
+                abort(400)
+            file_abspath = op.join(self.ds.path, spec['path'])
+            error = self._get_path_error(
+                file_abspath, fail_nonexistent=delete)
+            if error:
+                abort(error)
+            change = FileChange(
+                self._get_relpath(file_abspath),
+                content=spec.get('content'),
+                json=json_mode,
+                delete=delete)
+            self._validate_change(change)
+            changes.append(change)
+        if args.defer:
+            rv = jsonify({
+                'pending': self._submit(
+                    self.writequeue.submit, changes, to_git=args.togit),
+                # saving queued changes failed, they are retried
+                'error': self.writequeue.error,
+            })
+            rv.status_code = 202
+            return rv
+        return self._write(
+            self.writer.submit_changes,
+            changes,
+            message=args.message,
             to_git=args.togit,
-            #message="",
         )
 
     @verify_authentication
@@ -154,7 +578,17 @@ class FileResource(WebAppResource):
             abort(400)
         file_abspath = self._validate_file_path(path)
 
-        return self.ds.remove(
-            file_abspath,
-            check=args.verify_availability,
-        )
+        # ensure bound dataset methods
+        import datalad.api
+
+        def remove():
+            with metrics.time_datalad_call('remove'):
+                res = self.ds.remove(
+                    file_abspath,
+                    check=args.verify_availability,
+                )
+            self.fileindex.update_from_results(
+                res, removed=[self._get_relpath(file_abspath)])
+            return res
+
+        return self._write(self.writer.submit, remove)
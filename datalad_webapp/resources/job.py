@@ -0,0 +1,49 @@
+from flask import abort
+from flask_restful import (
+    reqparse,
+)
+
+from datalad_webapp import verify_authentication
+from datalad_webapp.jsonprovider import jsonify
+from datalad_webapp.resource import WebAppResource
+from datalad.support.constraints import (
+    EnsureFloat,
+    EnsureRange,
+)
+import logging
+lgr = logging.getLogger('datalad.webapp.resources.job')
+
+
+def _get_parser():
+    timeout_type = EnsureFloat() & EnsureRange(min=0, max=60)
+    rp = reqparse.RequestParser()
+    rp.add_argument(
+        'timeout', type=timeout_type,
+        default=0,
+        help="""number of seconds to wait for an unfinished job to
+        finish before reporting its status (long-polling).
+        %s. {error_msg}""" % repr(timeout_type),
+        location=['args', 'json', 'form'])
+    return rp
+
+
+class JobResource(WebAppResource):
+    """Status of background content retrieval jobs"""
+    _urlarg_spec = '<string:job_id>'
+
+    # request parser, built once
+    rp = _get_parser()
+
+    @verify_authentication
+    def get(self, job_id=None):
+        if job_id is None:
+            return jsonify({
+                'jobs': [j.as_dict() for j in self.transfers.jobs],
+            })
+        job = self.transfers.get_job(job_id)
+        if job is None:
+            abort(404)
+        args = self.rp.parse_args()
+        if args.timeout:
+            job.wait(timeout=args.timeout)
+        return jsonify(job.as_dict())
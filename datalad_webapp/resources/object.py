@@ -0,0 +1,94 @@
+from flask import (
+    abort,
+    current_app,
+    request,
+)
+import re
+import subprocess
+
+from datalad_webapp import verify_authentication
+from datalad_webapp.content import (
+    chunk_size,
+    send_content,
+)
+from datalad_webapp.httpcache import (
+    not_modified,
+    set_cache_headers,
+)
+from datalad_webapp.resource import WebAppResource
+import logging
+lgr = logging.getLogger('datalad.webapp.resources.object')
+
+# names of git objects (SHA-1 or SHA-256)
+_sha_regex = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+# larger blobs are streamed from a 'git cat-file' process of their own,
+# rather than read into memory from the shared batch process
+max_inline_blob_size = chunk_size
+
+
+def _iter_blob(cwd, sha):
+    proc = subprocess.Popen(
+        ['git', 'cat-file', 'blob', sha],
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for chunk in iter(lambda: proc.stdout.read(chunk_size), b''):
+            yield chunk
+    finally:
+        # the response may be closed before all of it was sent
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+class ObjectResource(WebAppResource):
+    """File content by annex key or git blob SHA
+
+    Content is served straight from the annex object store, or from git,
+    without looking at the working tree. As the key identifies the
+    content, responses never change and can be cached forever. Keys of
+    files are reported by the 'file' resource (with keys=yes).
+
+    Content that is not available locally is not retrieved, request the
+    file by path instead.
+    """
+    _urlarg_spec = '<string:key>'
+
+    @verify_authentication
+    def get(self, key=None):
+        if key is None:
+            # BadRequest
+            abort(400)
+        # nothing to look up, if the client has it already
+        rv = not_modified(key, immutable=True)
+        if rv is not None:
+            return rv
+        if not key.isprintable():
+            # cannot be sent to the batch processes
+            abort(404)
+        if _sha_regex.match(key):
+            return self._send_blob(key)
+        path = self.batch.contentlocation(key)
+        if path is None:
+            # no such key, or content not present
+            abort(404)
+        return send_content(path, etag=key, immutable=True)
+
+    def _send_blob(self, sha):
+        obj = self.batch.cat_file_check(sha)
+        if obj is None or obj[1] != 'blob':
+            abort(404)
+        size = obj[2]
+        if size > max_inline_blob_size:
+            content = _iter_blob(self.ds.path, sha)
+        else:
+            content = self.batch.cat_file(sha)[2]
+        rv = current_app.response_class(
+            content, mimetype='application/octet-stream')
+        rv.content_length = size
+        set_cache_headers(rv, sha, immutable=True)
+        return rv.make_conditional(
+            request, accept_ranges=True, complete_length=size)
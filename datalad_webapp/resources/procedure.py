@@ -5,9 +5,6 @@ from flask_restful import (
 )
 import os.path as op
 
-# ensure bound dataset method
-import datalad.interface.run_procedure
-
 from datalad_webapp import verify_authentication
 from datalad_webapp.resource import WebAppResource
 from datalad_webapp.resources.subdataset import RelPath
@@ -33,4 +30,9 @@ class ProcedureResource(WebAppResource):
     @verify_authentication
     @marshal_with(resource_fields, envelope='results')
     def get(self):
-        return self.ds.run_procedure(discover=True)
+        # ensure bound dataset method
+        import datalad.interface.run_procedure
+        return self.cache.get(
+            'run_procedure',
+            dict(discover=True),
+            lambda: self.ds.run_procedure(discover=True))
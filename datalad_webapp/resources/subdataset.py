@@ -1,15 +1,26 @@
 from flask_restful import (
     fields,
-    marshal_with,
+    marshal,
     reqparse,
 )
+import hashlib
 import os.path as op
 
-# ensure bound dataset method
-import datalad.distribution.subdatasets
-
 from datalad_webapp import verify_authentication
+from datalad_webapp.content import ndjson_response
+from datalad_webapp.httpcache import (
+    get_commit_time,
+    make_etag,
+    not_modified,
+    set_cache_headers,
+)
+from datalad_webapp.jsonprovider import jsonify
 from datalad_webapp.resource import WebAppResource
+from datalad.support.constraints import (
+    EnsureBool,
+    EnsureInt,
+    EnsureRange,
+)
 
 
 class RelPath(fields.String):
@@ -20,23 +31,85 @@ class RelPath(fields.String):
 resource_fields = {
     'name': fields.String(attribute="gitmodule_name"),
     'path': RelPath(
-        attribute=lambda x: (x['path'], x['refds'] if 'refds' in x else None)),
+        attribute=lambda x: (
+            x['path'], x['refds'] if 'refds' in x else None)),
     'parentds': RelPath(
-        attribute=lambda x: (x['parentds'], x['refds'] if 'refds' in x else None)),
+        attribute=lambda x: (
+            x['parentds'], x['refds'] if 'refds' in x else None)),
     'revision': fields.String,
     'url': fields.String(attribute="gitmodule_url"),
 }
 
 
+def _get_parser():
+    bool_type = EnsureBool()
+    depth_type = EnsureInt() & EnsureRange(min=1)
+    rp = reqparse.RequestParser()
+    rp.add_argument('fulfilled', type=bool)
+    rp.add_argument('recursive', type=bool)
+    rp.add_argument(
+        'max_depth', type=depth_type,
+        help="""maximum number of levels of subdatasets to report,
+        implies recursive. %s. {error_msg}""" % repr(depth_type))
+    rp.add_argument(
+        'stream', type=bool_type,
+        default=False,
+        help="""flag whether to stream subdataset records as
+        newline-delimited JSON, as soon as they are found.
+        %s. {error_msg}""" % repr(bool_type))
+    return rp
+
+
 class SubdatasetResource(WebAppResource):
+    # request parser, built once
+    rp = _get_parser()
+
     @verify_authentication
-    @marshal_with(resource_fields, envelope='results')
     def get(self, fulfilled=None, recursive=False):
-        psr = reqparse.RequestParser()
-        psr.add_argument('fulfilled', type=bool)
-        psr.add_argument('recursive', type=bool)
-        args = psr.parse_args()
-        return self.ds.subdatasets(**args)
+        args = self.rp.parse_args()
+        cmd_args = dict(
+            fulfilled=args.fulfilled,
+            recursive=args.recursive,
+        )
+        if args.max_depth is not None:
+            cmd_args.update(recursive=True, recursion_limit=args.max_depth)
+        etag = last_modified = None
+        if not cmd_args['recursive'] and cmd_args['fulfilled'] is None:
+            # reported from .gitmodules and the git index of this dataset,
+            # whether subdatasets are installed does not matter
+            head, stamp = self.fileindex.version
+            # the arguments may come in the body, not just the URL, and
+            # select a different representation
+            etag = make_etag(
+                head, stamp, args.stream, args.fulfilled, args.recursive)
+            last_modified = get_commit_time(self.batch, head)
+            rv = not_modified(etag, last_modified)
+            if rv is not None:
+                return rv
+        # ensure bound dataset method
+        import datalad.distribution.subdatasets
+        if args.stream:
+            rv = ndjson_response(
+                marshal(r, resource_fields)
+                for r in self.ds.subdatasets(
+                    return_type='generator', **cmd_args))
+            return rv if etag is None \
+                else set_cache_headers(rv, etag, last_modified)
+        rv = jsonify(marshal(
+            self.cache.get(
+                'subdatasets',
+                cmd_args,
+                lambda: self.ds.subdatasets(**cmd_args)),
+            resource_fields,
+            envelope='results'))
+        if etag is None:
+            # depends on the state of (installed) subdatasets too, but
+            # the response can still be revalidated
+            etag = hashlib.sha1(rv.get_data()).hexdigest()
+            not_modified_rv = not_modified(etag)
+            if not_modified_rv is not None:
+                return not_modified_rv
+        return set_cache_headers(rv, etag, last_modified)
 
     # XXX could be added to change subdataset properties
     #def post()
@@ -0,0 +1,75 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Serve a webapp with a multi-worker WSGI server"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+lgr = logging.getLogger('datalad.webapp.serving')
+
+
+def serve(app, host, port, threads=4, processes=1):
+    """Serve a WSGI app with a production WSGI server
+
+    A single process with a pool of worker threads is served by `waitress`.
+    Multiple (pre-forked) processes, each with its own pool of worker
+    threads, are served by `gunicorn`. The respective server must be
+    installed.
+
+    Parameters
+    ----------
+    app : WSGI app
+    host : str
+      Interface to bind to.
+    port : int
+      Port to bind to.
+    threads : int
+      Number of worker threads per process.
+    processes : int
+      Number of worker processes.
+    """
+    if processes > 1:
+        _serve_gunicorn(app, host, port, threads, processes)
+    else:
+        _serve_waitress(app, host, port, threads)
+
+
+def _serve_waitress(app, host, port, threads):
+    try:
+        import waitress
+    except ImportError:
+        raise RuntimeError(
+            "'waitress' must be installed to serve in 'production' mode")
+    lgr.info('Serving on %s:%i with %i threads', host, port, threads)
+    waitress.serve(app, host=host, port=port, threads=threads)
+
+
+def _serve_gunicorn(app, host, port, threads, processes):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise RuntimeError(
+            "'gunicorn' must be installed to serve in 'production' mode "
+            "with more than one process")
+
+    class GunicornApp(BaseApplication):
+        def load_config(self):
+            for k, v in dict(
+                    bind='{}:{}'.format(host, port),
+                    workers=processes,
+                    threads=threads,
+                    worker_class='gthread' if threads > 1 else 'sync').items():
+                self.cfg.set(k, v)
+
+        def load(self):
+            return app
+
+    lgr.info('Serving on %s:%i with %i processes with %i threads each',
+             host, port, processes, threads)
+    GunicornApp().run()
@@ -1,6 +1,12 @@
 import flask
 
 
+def authenticate(client, key='dummy', url='/api/v1/auth', headers=None):
+    """Obtain a session for all further requests of a test client"""
+    return client.get(url, headers=dict(
+        headers or {}, Authorization='Bearer {}'.format(key)))
+
+
 def assert_get_resource_needs_authentication(client, res):
     # unauthorized access is prevented
     rv = client.get('/api/v1/' + res)
@@ -9,8 +15,13 @@ def assert_get_resource_needs_authentication(client, res):
     # we get no magic authentication
     assert 'api_key' not in flask.session
 
-    # authenticate
+    # the session is not handed out without a key
     rv = client.get('/api/v1/auth')
+    assert rv.status_code == 401
+    assert 'api_key' not in flask.session
+
+    # authenticate
+    rv = authenticate(client)
     assert rv.status_code == 200
 
     # request list of files
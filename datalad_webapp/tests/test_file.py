@@ -1,7 +1,9 @@
 import pytest
 import flask
 import json
+import os
 import os.path as op
+import subprocess
 
 from datalad.api import (
     create,
@@ -16,7 +18,10 @@ from datalad.tests.utils import (
     ok_clean_git,
 )
 
-from datalad_webapp.tests.helpers import assert_get_resource_needs_authentication
+from datalad_webapp.tests.helpers import (
+    assert_get_resource_needs_authentication,
+    authenticate,
+)
 
 
 @pytest.fixture
@@ -45,7 +50,7 @@ def test_server_startup(client):
 def test_read(client):
     client, ds = client
     with client as c:
-        assert c.get('/api/v1/auth').status_code == 200
+        assert authenticate(c).status_code == 200
         existing_files = c.get('/api/v1/file').get_json()['files']
 
         file_content = '{"three": 3}'
@@ -95,7 +100,7 @@ def test_delete(client):
     client, ds = client
     with client as c:
         assert client.delete('/api/v1/file').status_code == 401
-        assert c.get('/api/v1/auth').status_code == 200
+        assert authenticate(c).status_code == 200
 
         # missing path
         assert client.delete('/api/v1/file').status_code == 400
@@ -126,7 +131,7 @@ def test_delete(client):
 def test_put(client):
     client, ds = client
     with client as c:
-        assert c.get('/api/v1/auth').status_code == 200
+        assert authenticate(c).status_code == 200
     ok_clean_git(ds.path)
 
     testpath = 'subdir/dummy'
@@ -154,3 +159,731 @@ def test_put(client):
             content=content)
         count += 1
         ok_clean_git(ds.path)
+
+
+def test_fileindex(tmpdir):
+    from datalad_webapp.fileindex import FileIndex
+    ds = create(tmpdir.strpath)
+    idx = FileIndex(ds)
+    assert idx.files == sorted(ds.repo.get_indexed_files())
+    assert 'subdir/dummy' not in idx.files
+
+    # changes made outside the webapp are detected
+    create_tree(ds.path, {'subdir': {'dummy': 'some'}})
+    ds.save()
+    assert 'subdir/dummy' in idx.files
+    assert idx.glob('subdir/*') == ['subdir/dummy']
+
+    # incremental updates do not trigger a rebuild
+    idx.update(added=['fake'], removed=['subdir/dummy'])
+    assert 'fake' in idx.files
+    assert 'subdir/dummy' not in idx.files
+    idx.invalidate()
+    assert idx.files == sorted(ds.repo.get_indexed_files())
+
+    # only confirmed modifications are applied
+    res = [{'action': 'add', 'type': 'file', 'status': 'ok',
+            'path': op.join(ds.path, 'added'), 'refds': ds.path}]
+    idx.update_from_results(res, added=['added'])
+    assert 'added' in idx.files
+    idx.update_from_results(res, added=['added', 'unconfirmed'])
+    assert idx.files == sorted(ds.repo.get_indexed_files())
+
+
+def test_put_into_subdataset(client):
+    client, ds = client
+    ds.create('sub')
+    with client as c:
+        assert authenticate(c).status_code == 200
+        assert c.put('/api/v1/file/sub/inner',
+                     json={'content': 'inner'}).status_code == 200
+        # the file is saved in the subdataset, not in the dataset
+        assert c.get('/api/v1/file').get_json()['files'] == sorted(
+            ds.repo.get_indexed_files())
+        assert 'sub/inner' not in c.get('/api/v1/file').get_json()['files']
+
+
+def test_list_paginated(client):
+    client, ds = client
+    with client as c:
+        assert authenticate(c).status_code == 200
+        create_tree(ds.path, {
+            'subdir': {'f{}'.format(i): str(i) for i in range(5)},
+            'other': {'f0': 'other'},
+        })
+        ds.save()
+        assert c.get('/api/v1/file/subdir/*').get_json()['files'] == \
+            ['subdir/f{}'.format(i) for i in range(5)]
+
+        files = []
+        cursor = None
+        while True:
+            rq = c.get('/api/v1/file/subdir/*', query_string=dict(
+                limit=2, **({'cursor': cursor} if cursor else {})))
+            assert rq.status_code == 200
+            page = rq.get_json()
+            assert len(page['files']) <= 2
+            files.extend(page['files'])
+            cursor = page['next']
+            if cursor is None:
+                break
+        assert files == ['subdir/f{}'.format(i) for i in range(5)]
+
+        # invalid limit
+        assert c.get('/api/v1/file?limit=0').status_code == 400
+
+
+def test_read_raw(client):
+    client, ds = client
+    with client as c:
+        assert authenticate(c).status_code == 200
+        create_tree(ds.path, {'subdir': {'dummy': '0123456789'}})
+        ds.save()
+        url = '/api/v1/file/subdir/dummy?raw=yes'
+
+        rq = c.get(url)
+        assert rq.status_code == 200
+        assert rq.data == b'0123456789'
+        assert rq.headers['Accept-Ranges'] == 'bytes'
+        etag = rq.headers['ETag']
+        assert etag
+
+        # partial content
+        rq = c.get(url, headers={'Range': 'bytes=2-4'})
+        assert rq.status_code == 206
+        assert rq.data == b'234'
+
+        # conditional request
+        rq = c.get(url, headers={'If-None-Match': etag})
+        assert rq.status_code == 304
+        assert rq.data == b''
+
+
+def test_read_json_stream(client):
+    client, ds = client
+    with client as c:
+        assert authenticate(c).status_code == 200
+        records = [{'id': i, 'name': 'rec{}'.format(i)} for i in range(5)]
+        create_tree(ds.path, {
+            'meta.json': '\n'.join(json.dumps(r) for r in records)})
+        ds.save()
+        url = '/api/v1/file/meta.json?json=stream'
+
+        rq = c.get(url)
+        assert rq.status_code == 200
+        assert rq.get_json() == {'path': 'meta.json', 'content': records}
+
+        # paging and projection
+        assert c.get(
+            url + '&offset=1&limit=2&fields=id').get_json()['content'] == \
+            [{'id': 1}, {'id': 2}]
+
+        # newline-delimited JSON
+        rq = c.get(url + '&raw=yes&offset=3')
+        assert rq.mimetype == 'application/x-ndjson'
+        assert [json.loads(l) for l in rq.data.splitlines()] == records[3:]
+
+        # a broken record ends the stream with an error
+        create_tree(ds.path, {
+            'broken.json': '\n'.join(
+                [json.dumps(r) for r in records[:2]] + ['{broken']),
+        })
+        ds.save()
+        url = '/api/v1/file/broken.json?json=stream'
+        content = c.get(url).get_json()
+        assert content['content'] == records[:2]
+        assert 'record 3' in content['error']
+        lines = [json.loads(l)
+                 for l in c.get(url + '&raw=yes').data.splitlines()]
+        assert lines[:2] == records[:2]
+        assert 'record 3' in lines[2]['error']
+
+
+def test_read_background(client):
+    client, ds = client
+    with client as c:
+        assert_get_resource_needs_authentication(client, 'job')
+        create_tree(ds.path, {'subdir': {'dummy': 'content'}})
+        ds.save()
+
+        rq = c.get('/api/v1/file/subdir/dummy?wait=no')
+        if rq.status_code == 202:
+            job = rq.get_json()
+            assert job['path'] == 'subdir/dummy'
+            assert rq.headers['Location'].endswith(
+                '/api/v1/job/{}'.format(job['id']))
+            # long-poll for the job to finish
+            rq = c.get('/api/v1/job/{}?timeout=30'.format(job['id']))
+            assert rq.get_json()['status'] == 'ok'
+            assert job['id'] in [
+                j['id'] for j in c.get('/api/v1/job').get_json()['jobs']]
+            rq = c.get('/api/v1/file/subdir/dummy')
+        assert rq.status_code == 200
+        assert rq.get_json()['content'] == 'content'
+
+        assert c.get('/api/v1/job/nothere').status_code == 404
+
+
+def test_read_deduplicated(tmpdir):
+    import threading
+    from datalad.api import clone
+    origin = create(op.join(tmpdir.strpath, 'origin'))
+    # same content, same annex key
+    create_tree(origin.path, {'one': 'same', 'two': 'same'})
+    origin.save()
+    ds = clone(origin.path, op.join(tmpdir.strpath, 'clone'))
+    assert ds.repo.get_file_key('one') == ds.repo.get_file_key('two')
+    app = webapp(
+        dataset=ds.path,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    transfers = app.extensions['datalad_webapp']['transfers']
+    # hold retrievals until all requests are made
+    calls = []
+    release = threading.Event()
+    get = transfers._get
+
+    def gated_get(file_abspath):
+        calls.append(file_abspath)
+        release.wait(30)
+        return get(file_abspath)
+    transfers._get = gated_get
+    with app.test_client() as c:
+        assert authenticate(c).status_code == 200
+        jobs = []
+        for path in ('one', 'one', 'two'):
+            rq = c.get('/api/v1/file/{}?wait=no'.format(path))
+            assert rq.status_code == 202
+            jobs.append(rq.get_json()['id'])
+        # a single job for all of them
+        assert len(set(jobs)) == 1
+        assert transfers.get_job(jobs[0]) is transfers.jobs[-1]
+        release.set()
+        for path in ('one', 'two'):
+            rq = c.get('/api/v1/file/' + path)
+            assert rq.get_json()['content'] == 'same'
+    # and a single retrieval
+    assert calls == [op.join(ds.path, 'one')]
+    assert len(transfers.jobs) == 1
+
+
+def test_has_local_content(tmpdir):
+    from datalad_webapp.content import has_local_content
+    ds = create(tmpdir.strpath)
+    create_tree(ds.path, {'annexed': 'annexed', 'ingit': 'ingit'})
+    ds.save('annexed')
+    ds.save('ingit', to_git=True)
+    for f in ('annexed', 'ingit'):
+        assert has_local_content(op.join(ds.path, f))
+    ds.drop('annexed', check=False)
+    assert not has_local_content(op.join(ds.path, 'annexed'))
+    assert has_local_content(op.join(ds.path, 'ingit'))
+    assert not has_local_content(op.join(ds.path, 'nothere'))
+
+
+def test_read_only_missing_content(tmpdir):
+    ds = create(tmpdir.strpath)
+    create_tree(ds.path, {'annexed': 'annexed'})
+    ds.save()
+    ds.drop('annexed', check=False)
+    app = webapp(
+        dataset=ds.path,
+        read_only=True,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    with app.test_client() as c:
+        assert authenticate(c).status_code == 200
+        for url in ('/api/v1/file/annexed', '/api/v1/file/annexed?raw=yes'):
+            rq = c.get(url)
+            assert rq.status_code == 404
+            assert rq.get_json()['message'] == \
+                'file content is not available locally'
+        rq = c.post('/api/v1/file', json={'paths': ['annexed']})
+        assert rq.status_code == 200
+        assert json.loads(rq.data) == {
+            'path': 'annexed',
+            'error': 'file content is not available locally'}
+    # nothing was retrieved
+    assert not ds.repo.file_has_content('annexed')
+
+
+def test_read_batch(client):
+    client, ds = client
+    with client as c:
+        assert c.post('/api/v1/file').status_code == 401
+        assert authenticate(c).status_code == 200
+        assert c.post('/api/v1/file').status_code == 400
+        create_tree(ds.path, {
+            'subdir': {'one': '1', 'two': '2'},
+            'three': '3',
+        })
+        ds.save()
+        rq = c.post(
+            '/api/v1/file',
+            data=json.dumps(dict(
+                path='subdir/*',
+                paths=['three', 'nothere'],
+                json='yes',
+            )),
+            content_type='application/json',
+        )
+        assert rq.status_code == 200
+        res = {r['path']: r for r in
+               (json.loads(l) for l in rq.data.splitlines())}
+        assert len(res) == 4
+        assert res['subdir/one']['content'] == 1
+        assert res['subdir/two']['content'] == 2
+        assert res['three']['content'] == 3
+        assert 'content' not in res['nothere']
+        assert res['nothere']['error'] == 'no such file'
+
+
+def test_write_batch(client):
+    client, ds = client
+    with client as c:
+        assert authenticate(c).status_code == 200
+        create_tree(ds.path, {'old': 'old', 'replaced': 'replaced'})
+        ds.save()
+        def ncommits():
+            return int(subprocess.check_output(
+                ['git', 'rev-list', '--count', 'HEAD'], cwd=ds.path))
+        ncommits_before = ncommits()
+
+        def patch(**kwargs):
+            return c.patch(
+                '/api/v1/file',
+                data=json.dumps(kwargs),
+                content_type='application/json',
+            )
+
+        # invalid change specs
+        assert patch(changes=[{'path': 'nocontent'}]).status_code == 400
+        assert patch(changes=[{'path': 'nothere', 'delete': True}]) \
+            .status_code == 404
+        assert patch(changes=[{'path': 'old', 'delete': 'maybe'}]) \
+            .status_code == 400
+        # invalid content is rejected upfront, nothing is modified
+        rq = patch(changes=[
+            {'path': 'replaced', 'content': 'new'},
+            {'path': 'old', 'content': 'not json', 'json': 'yes'},
+        ])
+        assert rq.status_code == 400
+        assert 'invalid JSON' in rq.get_json()['message']
+        assert c.put(
+            '/api/v1/file/old',
+            data=json.dumps(dict(content='[1', json='stream')),
+            content_type='application/json').status_code == 400
+        ok_clean_git(ds.path)
+        assert ncommits() == ncommits_before
+        # not a deletion
+        rq = patch(changes=[
+            {'path': 'replaced', 'content': 'replaced', 'delete': 'false'}])
+        assert rq.status_code == 200
+        assert op.lexists(op.join(ds.path, 'replaced'))
+        ncommits_before = ncommits()
+
+        rq = patch(
+            changes=[
+                {'path': 'new/one', 'content': '1'},
+                {'path': 'new/two', 'content': '{"two": 2}', 'json': 'yes'},
+                {'path': 'replaced', 'content': 'new'},
+                {'path': 'old', 'delete': True},
+            ],
+            message='batch',
+        )
+        assert rq.status_code == 200
+        ok_clean_git(ds.path)
+        # a single commit
+        assert ncommits() == ncommits_before + 1
+        ok_file_has_content(op.join(ds.path, 'new', 'one'), '1')
+        ok_file_has_content(op.join(ds.path, 'replaced'), 'new')
+        assert not op.lexists(op.join(ds.path, 'old'))
+        files = c.get('/api/v1/file').get_json()['files']
+        assert 'new/two' in files
+        assert 'old' not in files
+
+        # write-behind
+        rq = patch(
+            changes=[{'path': 'deferred', 'content': 'later'}],
+            defer=True,
+        )
+        assert rq.status_code == 202
+        assert rq.get_json()['pending'] == 1
+        import time
+        for i in range(100):
+            if 'deferred' in c.get('/api/v1/file').get_json()['files']:
+                break
+            time.sleep(0.2)
+        assert 'deferred' in c.get('/api/v1/file').get_json()['files']
+        ok_clean_git(ds.path)
+
+        # a full write-behind queue rejects further changes
+        writequeue = client.application.extensions['datalad_webapp'][
+            'writequeue']
+        writequeue.max_queue = 0
+        writequeue.max_delay = 60
+        try:
+            assert patch(
+                changes=[{'path': 'first', 'content': '1'}],
+                defer=True).status_code == 202
+            rq = patch(
+                changes=[{'path': 'second', 'content': '2'}],
+                defer=True)
+            assert rq.status_code == 503
+            assert int(rq.headers['Retry-After']) >= 1
+        finally:
+            writequeue.flush()
+
+
+def test_write_behind_failure(tmpdir):
+    from datalad_webapp.writer import (
+        FileChange,
+        WriteBehindQueue,
+        WriteQueueFull,
+    )
+    ds = create(op.join(tmpdir.strpath, 'ds'))
+    upload = op.join(tmpdir.strpath, 'upload')
+    wq = WriteBehindQueue(ds, max_delay=60)
+    # uploaded content that is not there
+    wq.submit([FileChange('uploaded', source=upload)])
+    with pytest.raises(ValueError):
+        wq.flush()
+    # kept, and the failure is reported
+    assert wq.pending == 1
+    assert 'uploaded' in wq.error
+    wq.submit([FileChange('fine', content='fine')])
+    assert wq.pending == 2
+    with open(upload, 'w') as f:
+        f.write('uploaded')
+    wq.flush()
+    assert wq.error is None
+    assert wq.pending == 0
+    ok_file_has_content(op.join(ds.path, 'uploaded'), 'uploaded')
+    ok_file_has_content(op.join(ds.path, 'fine'), 'fine')
+    ok_clean_git(ds.path)
+
+    # changes that keep failing are dropped, and do not block others
+    wq = WriteBehindQueue(ds, max_delay=60, max_attempts=2)
+    wq.submit([FileChange('gone', source=upload + '.gone')])
+    for i in range(2):
+        with pytest.raises(ValueError):
+            wq.flush()
+    assert wq.pending == 0
+    assert 'dropped changes of gone' in wq.error
+    wq.submit([FileChange('later', content='later')])
+    wq.flush()
+    ok_file_has_content(op.join(ds.path, 'later'), 'later')
+
+    # the number of queued changes is limited
+    wq = WriteBehindQueue(ds, max_delay=60, max_queue=2)
+    assert wq.submit([FileChange('a', 'a'), FileChange('b', 'b')]) == 2
+    with pytest.raises(WriteQueueFull) as e:
+        wq.submit([FileChange('c', 'c')])
+    assert 1 <= e.value.retry_after <= 60
+    wq.flush()
+    assert wq.submit([FileChange('c', 'c')]) == 1
+    wq.flush()
+
+
+def test_write_behind_retry(tmpdir, monkeypatch):
+    import time
+    from datalad_webapp import writer
+    ds = create(tmpdir.strpath)
+    attempts = []
+
+    def failing(*args, **kwargs):
+        attempts.append(time.time())
+        raise RuntimeError('save failed')
+    monkeypatch.setattr(writer, 'apply_changes', failing)
+    # a full queue does not skip waiting after a failure
+    wq = writer.WriteBehindQueue(
+        ds, max_pending=1, max_delay=0.5, max_attempts=100)
+    wq.submit([writer.FileChange('f', 'f')])
+    time.sleep(1.2)
+    wq.close()
+    # immediate first attempt, two retries, and the one at close()
+    assert 2 <= len(attempts) <= 5
+
+
+def test_put_upload(client):
+    import gzip
+    import io
+    client, ds = client
+    with client as c:
+        assert authenticate(c).status_code == 200
+        content = bytes(range(256)) * 10
+
+        # raw, binary body
+        rq = c.put('/api/v1/file/raw', data=content,
+                   content_type='application/octet-stream')
+        assert rq.status_code == 200
+        with open(op.join(ds.path, 'raw'), 'rb') as f:
+            assert f.read() == content
+
+        # compressed
+        rq = c.put('/api/v1/file/gzipped', data=gzip.compress(content),
+                   content_type='application/octet-stream',
+                   headers={'Content-Encoding': 'gzip'})
+        assert rq.status_code == 200
+        with open(op.join(ds.path, 'gzipped'), 'rb') as f:
+            assert f.read() == content
+        rq = c.put('/api/v1/file/bogus', data=content,
+                   content_type='application/octet-stream',
+                   headers={'Content-Encoding': 'bogus'})
+        assert rq.status_code == 415
+        # content that cannot be decoded is rejected, nothing is kept
+        upload_dir = op.join(ds.path, '.git', 'datalad_webapp', 'uploads')
+        rq = c.put('/api/v1/file/badgzip', data=content,
+                   content_type='application/octet-stream',
+                   headers={'Content-Encoding': 'gzip'})
+        assert rq.status_code == 400
+        rq = c.put('/api/v1/file/truncated',
+                   data=gzip.compress(content)[:100],
+                   content_type='application/octet-stream',
+                   headers={'Content-Encoding': 'gzip'})
+        assert rq.status_code == 400
+        assert os.listdir(upload_dir) == []
+        assert not op.lexists(op.join(ds.path, 'badgzip'))
+
+        # multipart form upload
+        rq = c.put('/api/v1/file/form',
+                   data={'content': (io.BytesIO(content), 'form')},
+                   content_type='multipart/form-data')
+        assert rq.status_code == 200
+        with open(op.join(ds.path, 'form'), 'rb') as f:
+            assert f.read() == content
+
+        # resumable upload in chunks
+        def put_chunk(start, stop):
+            return c.put(
+                '/api/v1/file/chunked', data=content[start:stop],
+                content_type='application/octet-stream',
+                headers={'Content-Range': 'bytes {}-{}/{}'.format(
+                    start, stop - 1, len(content))})
+
+        rq = put_chunk(0, 1000)
+        assert rq.status_code == 202
+        assert rq.headers['Range'] == 'bytes=0-999'
+        # out of order chunk is rejected
+        rq = put_chunk(2000, 2560)
+        assert rq.status_code == 409
+        assert rq.get_json()['received'] == 1000
+        # status query
+        rq = c.put('/api/v1/file/chunked',
+                   content_type='application/octet-stream',
+                   headers={'Content-Range': 'bytes */{}'.format(
+                       len(content))})
+        assert rq.get_json() == {'received': 1000, 'total': len(content)}
+        assert 'chunked' not in c.get('/api/v1/file').get_json()['files']
+        assert put_chunk(1000, 2000).status_code == 202
+        assert put_chunk(2000, 2560).status_code == 200
+        with open(op.join(ds.path, 'chunked'), 'rb') as f:
+            assert f.read() == content
+        assert 'chunked' in c.get('/api/v1/file').get_json()['files']
+        ok_clean_git(ds.path)
+
+
+def test_batched_repo(tmpdir):
+    from datalad.api import clone
+    from datalad_webapp.batch import BatchedRepo
+    from datalad_webapp.transfer import TransferScheduler
+    origin = create(op.join(tmpdir.strpath, 'origin'))
+    create_tree(origin.path, {'annexed': 'annexed', 'other': 'other',
+                              'ingit': 'ingit'})
+    origin.save(['annexed', 'other'])
+    origin.save('ingit', to_git=True)
+    ds = clone(origin.path, op.join(tmpdir.strpath, 'clone'))
+    batch = BatchedRepo(ds)
+    try:
+        sha, type_, content = batch.cat_file('HEAD:ingit')
+        assert (type_, content) == ('blob', b'ingit')
+        assert batch.cat_file_check(sha) == (sha, 'blob', 5)
+        assert batch.cat_file_check('HEAD:nothere') is None
+        assert batch.cat_file(sha)[2] == b'ingit'
+        assert batch.cat_file('HEAD:nothere') is None
+
+        key = batch.lookupkey('annexed')
+        assert key == op.basename(os.readlink(op.join(ds.path, 'annexed')))
+        assert batch.lookupkey('ingit') is None
+        assert batch.contentlocation(key) is None
+
+        res = batch.get(op.join(ds.path, 'annexed'))
+        assert res['success']
+        with open(batch.contentlocation(key)) as f:
+            assert f.read() == 'annexed'
+        # nothing to do
+        assert batch.get('annexed') is None
+
+        # processes are restarted after they went away
+        batch.close()
+        assert batch.cat_file('HEAD:ingit')[2] == b'ingit'
+
+        # background retrievals use the batch processes
+        transfers = TransferScheduler(ds, batch=batch)
+        res = transfers.submit(op.join(ds.path, 'other')).result()
+        assert res[0]['status'] == 'ok'
+        assert res[0]['annexkey'] == batch.lookupkey('other')
+        with open(op.join(ds.path, 'other')) as f:
+            assert f.read() == 'other'
+        transfers.shutdown()
+    finally:
+        batch.close()
+
+
+def test_write_scheduler(client, monkeypatch):
+    import threading
+    import time
+    from datalad_webapp.writer import (
+        FileChange,
+        WriteQueueFull,
+        WriteScheduler,
+        dataset_write_lock,
+    )
+    client, ds = client
+
+    def ncommits():
+        return int(subprocess.check_output(
+            ['git', 'rev-list', '--count', 'HEAD'], cwd=ds.path))
+    ncommits_before = ncommits()
+
+    writer = WriteScheduler(ds, max_queue=2)
+    # keep the writer busy
+    busy = threading.Event()
+    blocker = writer.submit(busy.wait)
+    for i in range(100):
+        if not writer.pending:
+            break
+        time.sleep(0.05)
+    one = writer.submit_changes([FileChange('one', '1')], message='first')
+    two = writer.submit_changes([FileChange('two', '2')], message='second')
+    with pytest.raises(WriteQueueFull) as e:
+        writer.submit_changes([FileChange('three', '3')])
+    assert e.value.retry_after >= 1
+    busy.set()
+    assert blocker.result(timeout=30)
+    assert [r['path'] for r in one.result(timeout=30)
+            if r['type'] == 'file'] == [op.join(ds.path, 'one')]
+    assert [r['path'] for r in two.result(timeout=30)
+            if r['type'] == 'file'] == [op.join(ds.path, 'two')]
+    # saved together
+    assert ncommits() == ncommits_before + 1
+    message = subprocess.check_output(
+        ['git', 'log', '-1', '--format=%B'], cwd=ds.path).decode()
+    assert 'first' in message and 'second' in message
+    ok_clean_git(ds.path)
+
+    # a failing request does not fail the others of a group
+    busy.clear()
+    blocker = writer.submit(busy.wait)
+    for i in range(100):
+        if not writer.pending:
+            break
+        time.sleep(0.05)
+    bad = writer.submit_changes(
+        [FileChange('bad', 'not JSON', json='yes')])
+    good = writer.submit_changes([FileChange('good', 'good')])
+    busy.set()
+    with pytest.raises(Exception):
+        bad.result(timeout=30)
+    assert good.result(timeout=30)
+    ok_file_has_content(op.join(ds.path, 'good'), 'good')
+
+    # writers of other processes are excluded by a lock file
+    with dataset_write_lock(ds):
+        locked = writer.submit_changes([FileChange('locked', 'locked')])
+        time.sleep(0.5)
+        assert not locked.done()
+    assert locked.result(timeout=30)
+    ok_file_has_content(op.join(ds.path, 'locked'), 'locked')
+
+    # a failure outside of the save is reported, and the writer goes on
+    from datalad_webapp import writer as writer_module
+
+    def unlockable(dataset):
+        raise OSError('cannot lock')
+    monkeypatch.setattr(writer_module, 'dataset_write_lock', unlockable)
+    failed = writer.submit_changes([FileChange('failed', 'failed')])
+    with pytest.raises(OSError):
+        failed.result(timeout=30)
+    monkeypatch.undo()
+    assert writer.submit_changes(
+        [FileChange('after', 'after')]).result(timeout=30)
+    ok_file_has_content(op.join(ds.path, 'after'), 'after')
+
+    # requests do not wait forever for a busy writer
+    from datalad_webapp.resources import file as file_resource
+    app_writer = client.application.extensions['datalad_webapp']['writer']
+    monkeypatch.setattr(file_resource, 'write_timeout', 0.5)
+    busy = threading.Event()
+    app_writer.submit(busy.wait)
+    with client as c:
+        assert authenticate(c).status_code == 200
+        rq = c.put('/api/v1/file/slow', json={'content': 'slow'})
+        assert rq.status_code == 503
+    busy.set()
+    monkeypatch.undo()
+
+    # requests are rejected while the writer of the webapp is busy
+
+    def full(*args, **kwargs):
+        raise WriteQueueFull(7)
+    app_writer.submit_changes = full
+    with client as c:
+        assert authenticate(c).status_code == 200
+        rq = c.put(
+            '/api/v1/file/new',
+            data=json.dumps(dict(content='new')),
+            content_type='application/json')
+        assert rq.status_code == 503
+        assert rq.headers['Retry-After'] == '7'
+        # received content is not kept
+        rq = c.put('/api/v1/file/new', data=b'new',
+                   content_type='application/octet-stream')
+        assert rq.status_code == 503
+        assert os.listdir(op.join(
+            ds.path, '.git', 'datalad_webapp', 'uploads')) == []
+
+
+def test_object(client, monkeypatch):
+    from datalad_webapp.resources import object as object_resource
+    client, ds = client
+    with client as c:
+        assert authenticate(c).status_code == 200
+        create_tree(ds.path, {'annexed': 'annexed', 'ingit': 'ingit'})
+        ds.save('annexed')
+        ds.save('ingit', to_git=True)
+        keys = c.get('/api/v1/file?keys=yes').get_json()['keys']
+        assert keys['annexed'] == ds.repo.get_file_key('annexed')
+        assert keys['ingit'] == subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD:ingit'], cwd=ds.path).decode().strip()
+
+        for path in ('annexed', 'ingit'):
+            url = '/api/v1/object/' + keys[path]
+            rq = c.get(url)
+            assert rq.status_code == 200
+            assert rq.data == path.encode()
+            assert 'immutable' in rq.headers['Cache-Control']
+            etag = rq.headers['ETag']
+            assert c.get(url, headers={'If-None-Match': etag}).status_code \
+                == 304
+            rq = c.get(url, headers={'Range': 'bytes=1-2'})
+            assert rq.status_code == 206
+            assert rq.data == path[1:3].encode()
+
+        # large blobs are streamed
+        monkeypatch.setattr(object_resource, 'max_inline_blob_size', 2)
+        url = '/api/v1/object/' + keys['ingit']
+        rq = c.get(url)
+        assert rq.data == b'ingit'
+        assert rq.headers['Content-Length'] == '5'
+        rq = c.get(url, headers={'Range': 'bytes=1-2'})
+        assert rq.status_code == 206
+        assert rq.data == b'ng'
+
+        assert c.get('/api/v1/object/' + '0' * 40).status_code == 404
+        assert c.get('/api/v1/object/MD5E-s1--nothere').status_code == 404
+        # content is not retrieved
+        ds.drop('annexed', check=False)
+        assert c.get('/api/v1/object/' + keys['annexed']).status_code == 404
@@ -1,9 +1,16 @@
 import pytest
 import flask
+import json
+import os
+import os.path as op
 
 from datalad.api import create
 from datalad.api import webapp
 from datalad.tests.utils import with_tempfile
+from datalad_webapp.tests.helpers import (
+    assert_get_resource_needs_authentication,
+    authenticate,
+)
 
 
 @pytest.fixture
@@ -31,13 +38,445 @@ def test_server_startup(client):
         # we get no magic authentication
         assert 'api_key' not in flask.session
 
+        # no session without a key
+        assert client.get('/api/v1/auth').status_code == 401
+
         # authenticate
-        rv = client.get('/api/v1/auth')
+        rv = authenticate(client)
         assert rv.status_code == 200
-        assert {'api_key': 'dummy'} == rv.get_json()
+        assert {'message': 'authenticated'} == rv.get_json()
         assert 'api_key' in flask.session
 
         # authenticated request, yields empty list (no subdatasets here)
         rv = client.get('/api/v1/subdataset')
         assert rv.status_code == 200
         assert {'results': []} == rv.get_json()
+
+
+def test_create_app(tmpdir):
+    from datalad_webapp.app import (
+        create_app,
+        get_entry_points,
+    )
+    assert {'auth', 'file', 'job', 'procedure', 'subdataset'}.issubset(
+        ep.name for ep in get_entry_points('datalad.webapp.resources'))
+    # discovered only once
+    assert get_entry_points('datalad.webapp.resources') is \
+        get_entry_points('datalad.webapp.resources')
+
+    ds = create(tmpdir.strpath)
+    app = create_app(ds.path)
+    assert app.config['startup_time'] > 0
+    with app.test_client() as c:
+        assert authenticate(c).status_code == 200
+        assert c.get('/api/v1/subdataset').get_json() == {'results': []}
+
+
+def test_result_cache(client):
+    with client as c:
+        assert_get_resource_needs_authentication(client, 'cache')
+        assert c.delete('/api/v1/cache').get_json()['size'] == 0
+        for i in range(3):
+            assert c.get('/api/v1/subdataset').get_json() == {'results': []}
+        stats = c.get('/api/v1/cache').get_json()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 2
+        assert stats['size'] == 1
+        # different arguments, different result
+        c.get('/api/v1/subdataset?recursive=1')
+        assert c.get('/api/v1/cache').get_json()['size'] == 2
+
+
+def test_get_head_commit(tmpdir):
+    import subprocess
+    from datalad_webapp.cache import get_head_commit
+    ds = create(tmpdir.strpath)
+    assert get_head_commit(ds.repo.dot_git) == ds.repo.get_hexsha()
+    subprocess.check_call(['git', 'pack-refs', '--all'], cwd=ds.path)
+    assert get_head_commit(ds.repo.dot_git) == ds.repo.get_hexsha()
+
+
+def test_subdataset_stream(tmpdir):
+    ds = create(tmpdir.strpath)
+    sub = ds.create('sub')
+    sub.create('subsub')
+    ds.save(recursive=True)
+    app = webapp(
+        dataset=ds.path,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    with app.test_client() as c:
+        assert authenticate(c).status_code == 200
+        rq = c.get('/api/v1/subdataset?recursive=1&stream=yes')
+        assert rq.mimetype == 'application/x-ndjson'
+        streamed = [json.loads(l) for l in rq.data.splitlines()]
+        assert sorted(r['path'] for r in streamed) == \
+            ['sub', op.join('sub', 'subsub')]
+        assert streamed == c.get(
+            '/api/v1/subdataset?recursive=1').get_json()['results']
+
+        # level by level
+        assert [r['path'] for r in c.get(
+            '/api/v1/subdataset?max_depth=1').get_json()['results']] == \
+            ['sub']
+
+
+def test_compression(tmpdir):
+    import gzip
+    from datalad.tests.utils import create_tree
+    ds = create(op.join(tmpdir.strpath, 'ds'))
+    create_tree(ds.path, {'f{}'.format(i): str(i) for i in range(100)})
+    ds.save()
+    static = op.join(tmpdir.strpath, 'static')
+    create_tree(static, {'index.html': 'index', 'app.js': 'plain'})
+    with open(op.join(static, 'app.js.gz'), 'wb') as f:
+        f.write(gzip.compress(b'compressed'))
+    app = webapp(
+        dataset=ds.path,
+        static_root=static,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    with app.test_client() as c:
+        assert authenticate(c).status_code == 200
+        plain = c.get('/api/v1/file')
+        assert 'Content-Encoding' not in plain.headers
+        rq = c.get('/api/v1/file', headers={'Accept-Encoding': 'gzip'})
+        assert rq.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in rq.headers['Vary']
+        assert json.loads(gzip.decompress(rq.data)) == plain.get_json()
+        # small responses are not compressed
+        rq = authenticate(c, headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in rq.headers
+        # streamed responses
+        rq = c.post(
+            '/api/v1/file',
+            data=json.dumps(dict(path='f*')),
+            content_type='application/json',
+            headers={'Accept-Encoding': 'gzip'})
+        assert rq.headers['Content-Encoding'] == 'gzip'
+        assert len(gzip.decompress(rq.data).splitlines()) == 100
+
+        # pre-compressed static files
+        rq = c.get('/app.js', headers={'Accept-Encoding': 'gzip'})
+        assert rq.headers['Content-Encoding'] == 'gzip'
+        assert rq.mimetype in ('application/javascript', 'text/javascript')
+        assert gzip.decompress(rq.data) == b'compressed'
+        rq = c.get('/app.js')
+        assert 'Content-Encoding' not in rq.headers
+        assert rq.data == b'plain'
+
+
+def test_http_caching(tmpdir):
+    import gzip
+    from datalad.tests.utils import create_tree
+    ds = create(tmpdir.strpath)
+    create_tree(ds.path, {'f{}'.format(i): str(i) for i in range(100)})
+    ds.save()
+    ds.drop('f0', check=False)
+    ds.create('sub')
+    app = webapp(
+        dataset=ds.path,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    with app.test_client() as c:
+        assert authenticate(c).status_code == 200
+        for url in ('/api/v1/file',
+                    '/api/v1/subdataset',
+                    '/api/v1/subdataset?recursive=1',
+                    '/api/v1/file/f1',
+                    '/api/v1/file/f1?raw=yes'):
+            rq = c.get(url)
+            assert rq.status_code == 200
+            etag = rq.headers['ETag']
+            assert rq.headers['Cache-Control'] == 'no-cache'
+            rq = c.get(url, headers={'If-None-Match': etag})
+            assert rq.status_code == 304, url
+            assert rq.data == b''
+            assert rq.headers['ETag'] == etag
+        # listings are identified by HEAD
+        rq = c.get('/api/v1/file')
+        assert rq.last_modified
+        etag = rq.headers['ETag']
+        create_tree(ds.path, {'new': 'new'})
+        ds.save()
+        rq = c.get('/api/v1/file', headers={'If-None-Match': etag})
+        assert rq.status_code == 200
+        assert 'new' in rq.get_json()['files']
+
+        # annexed content is identified by its key, and not retrieved
+        # to answer a conditional request
+        key = ds.repo.get_file_key('f0')
+        rq = c.get('/api/v1/file/f0',
+                   headers={'If-None-Match': '"{}"'.format(key)})
+        assert rq.status_code == 304
+        assert not ds.repo.file_has_content('f0')
+        # unlocked annexed files as well
+        ds.unlock('f2')
+        rq = c.get('/api/v1/file/f2')
+        assert rq.headers['ETag'] == '"{}"'.format(
+            ds.repo.get_file_key('f2'))
+
+        # as are those of subdataset lists
+        etag = c.get('/api/v1/subdataset').headers['ETag']
+        rq = c.get('/api/v1/subdataset', json={'stream': True},
+                   headers={'If-None-Match': etag})
+        assert rq.status_code == 200
+        assert rq.mimetype == 'application/x-ndjson'
+
+        # listing arguments in the request body are part of the ETag
+        etag = c.get('/api/v1/file').headers['ETag']
+        rq = c.get('/api/v1/file', json={'limit': 1},
+                   headers={'If-None-Match': etag})
+        assert rq.status_code == 200
+        assert len(rq.get_json()['files']) == 1
+        rq = c.get('/api/v1/file', json={'path': 'f1*'},
+                   headers={'If-None-Match': etag})
+        assert rq.status_code == 200
+        assert rq.get_json()['files'] == ['f1'] + [
+            'f1{}'.format(i) for i in range(10)]
+
+        # compressed responses have their own ETag, either matches
+        rq = c.get('/api/v1/file', headers={'Accept-Encoding': 'gzip'})
+        assert rq.headers['Content-Encoding'] == 'gzip'
+        gzip_etag = rq.headers['ETag']
+        assert gzip_etag != c.get('/api/v1/file').headers['ETag']
+        assert gzip_etag.endswith('-gzip"')
+        rq = c.get('/api/v1/file', headers={'If-None-Match': gzip_etag})
+        assert rq.status_code == 304
+        assert rq.headers['ETag'] == gzip_etag
+
+
+def test_json_backends(client):
+    from collections import OrderedDict
+    from datalad_webapp import jsonprovider
+    obj = OrderedDict([('b', [1, 2.5, None, True]), ('a', {'x': 'ü'})])
+    try:
+        dumped = []
+        for backend in sorted(jsonprovider.backends):
+            try:
+                jsonprovider.set_backend(backend)
+                dumped.append(jsonprovider.dumps(obj))
+            except ImportError:
+                # optional backend not installed
+                continue
+            with client as c:
+                assert authenticate(c).get_json() == \
+                    {'message': 'authenticated'}
+                assert c.get('/api/v1/subdataset').get_json() == \
+                    {'results': []}
+        assert all(json.loads(d) == obj for d in dumped)
+    finally:
+        jsonprovider.set_backend()
+
+
+def test_authentication(tmpdir):
+    ds = create(tmpdir.strpath)
+    ds.config.add('datalad.webapp.api-key', 'secret1', where='local')
+    ds.config.add('datalad.webapp.api-key', 'secret2', where='local')
+    app = webapp(
+        dataset=ds.path,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    with app.test_client() as c:
+        url = '/api/v1/subdataset'
+        assert c.get(url).status_code == 401
+        for key in ('secret1', 'secret2'):
+            assert c.get(url, headers={
+                'Authorization': 'Bearer {}'.format(key)}).status_code == 200
+        assert c.get(url, headers={
+            'Authorization': 'Bearer dummy'}).status_code == 401
+        # key in a JSON body
+        assert c.get(
+            url,
+            data=json.dumps(dict(api_key='secret2')),
+            content_type='application/json').status_code == 200
+        assert c.get(
+            url,
+            data=json.dumps(['secret2']),
+            content_type='application/json').status_code == 401
+        # session, only with a valid key, which is never reported
+        assert c.get('/api/v1/auth').status_code == 401
+        assert authenticate(c, key='dummy').status_code == 401
+        assert c.get(url).status_code == 401
+        rv = authenticate(c, key='secret2')
+        assert rv.status_code == 200
+        assert 'secret' not in rv.get_data(as_text=True)
+        assert c.get(url).status_code == 200
+
+
+def test_metrics(tmpdir):
+    from datalad_webapp.metrics import Metrics
+    m = Metrics()
+    m.observe_request('fileresource', 'GET', 200, .003, 10)
+    m.observe_request('fileresource', 'GET', 200, 100, None)
+    m.count_transfers([
+        dict(action='get', type='file', status='ok'),
+        dict(action='get', type='file', status='notneeded'),
+        dict(action='get', type='dataset', status='ok'),
+    ])
+    with m.time_datalad_call('save'):
+        pass
+    lines = m.expose().splitlines()
+    for line in (
+            'datalad_webapp_requests_total'
+            '{endpoint="fileresource",method="GET",status="200"} 2',
+            'datalad_webapp_request_duration_seconds_bucket'
+            '{endpoint="fileresource",method="GET",le="0.0025"} 0',
+            'datalad_webapp_request_duration_seconds_bucket'
+            '{endpoint="fileresource",method="GET",le="0.005"} 1',
+            'datalad_webapp_request_duration_seconds_bucket'
+            '{endpoint="fileresource",method="GET",le="+Inf"} 2',
+            'datalad_webapp_request_duration_seconds_count'
+            '{endpoint="fileresource",method="GET"} 2',
+            'datalad_webapp_request_bytes_total{endpoint="fileresource"} 10',
+            'datalad_webapp_datalad_call_duration_seconds_count'
+            '{command="save"} 1',
+            'datalad_webapp_content_transfers_total 1'):
+        assert line in lines
+
+    ds = create(tmpdir.strpath)
+    app = webapp(
+        dataset=ds.path,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    with app.test_client() as c:
+        assert c.get('/metrics').status_code == 401
+        authenticate(c)
+        c.get('/api/v1/subdataset')
+        rq = c.get('/metrics')
+        assert rq.status_code == 200
+        assert rq.mimetype == 'text/plain'
+        text = rq.get_data(as_text=True)
+        assert 'datalad_webapp_requests_total' \
+            '{endpoint="subdatasetresource",method="GET",status="200"}' in text
+        assert 'datalad_webapp_datalad_call_duration_seconds_count' \
+            '{command="subdatasets"}' in text
+
+
+def test_profiling(tmpdir):
+    import glob
+    import pstats
+    from datalad.tests.utils import create_tree
+    from datalad_webapp.profiling import (
+        get_profile_dir,
+        prune_profiles,
+        summarize,
+    )
+    ds = create(tmpdir.strpath)
+    create_tree(ds.path, {'f{}'.format(i): str(i) for i in range(3)})
+    ds.save()
+    app = webapp(
+        dataset=ds.path,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    profile_dir = get_profile_dir(ds)
+    with app.test_client() as c:
+        # not without asking, and not without a valid key
+        assert 'Server-Timing' not in c.get('/api/v1/subdataset').headers
+        assert not glob.glob(op.join(profile_dir, '*.prof'))
+        authenticate(c)
+        rq = c.put(
+            '/api/v1/file/new',
+            data=json.dumps(dict(content='new')),
+            content_type='application/json',
+            headers={'X-Datalad-Profile': '1'})
+        assert rq.status_code == 200
+        assert rq.headers['Server-Timing'].startswith('total;dur=')
+        assert 'desc="0 processes"' not in rq.headers['Server-Timing']
+        profiles = glob.glob(op.join(profile_dir, '*.prof'))
+        assert len(profiles) == 1
+        assert profiles[0].endswith('-PUT-fileresource.prof')
+        summary = summarize(pstats.Stats(profiles[0]))
+        # saving runs git, on the writer thread
+        assert summary['processes'] > 0
+        assert summary['subprocess'] > 0
+        # streamed responses are saved once sent
+        rq = c.post(
+            '/api/v1/file',
+            data=json.dumps(dict(path='f*')),
+            content_type='application/json',
+            headers={'X-Datalad-Profile': '1'})
+        assert len(rq.data.splitlines()) == 3
+        assert 'Server-Timing' not in rq.headers
+        assert len(glob.glob(op.join(profile_dir, '*.prof'))) == 2
+        # profiles of quick successive requests do not overwrite each other
+        for i in range(3):
+            c.get('/api/v1/file', headers={'X-Datalad-Profile': '1'})
+        assert len(glob.glob(op.join(profile_dir, '*.prof'))) == 5
+    # only the most recent profiles are kept
+    prune_profiles(profile_dir, keep=2)
+    assert sorted(os.listdir(profile_dir)) == sorted(
+        op.basename(p)
+        for p in glob.glob(op.join(profile_dir, '*-GET-fileresource.prof'))
+    )[-2:]
+
+
+def test_multiple_datasets(tmpdir):
+    from datalad.tests.utils import create_tree
+    paths = {}
+    for name in ('one', 'two'):
+        ds = create(op.join(tmpdir.strpath, name))
+        create_tree(ds.path, {'{}.txt'.format(name): name})
+        ds.save()
+        paths[name] = ds.path
+    app = webapp(
+        datasets=['first={}'.format(paths['one']), paths['two']],
+        max_active=1,
+        mode='dry-run',
+        return_type='item-or-list',
+    )['app']
+    pool = app.extensions['datalad_webapp']['pool']
+    # nothing is set up before it is needed
+    assert pool.active == []
+    with app.test_client() as c:
+        assert c.get('/api/v1/datasets').status_code == 401
+        # nothing is set up for unauthenticated requests
+        assert c.get('/api/v1/first/file').status_code == 401
+        assert pool.active == []
+        assert authenticate(c, url='/api/v1/first/auth').status_code == 200
+        assert [d['id'] for d in c.get('/api/v1/datasets').get_json()[
+            'datasets']] == ['first', 'two']
+
+        assert 'one.txt' in c.get('/api/v1/first/file').get_json()['files']
+        assert pool.active == ['first']
+        assert c.get('/api/v1/two/file/two.txt').get_json()['content'] == \
+            'two'
+        # the idle dataset was dropped
+        assert pool.active == ['two']
+        # the state of a dataset is set up once, requests for it wait
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(4) as executor:
+            states = list(executor.map(
+                lambda i: pool.acquire('first'), range(4)))
+        assert all(s is states[0] for s in states)
+        for s in states:
+            pool.release(s)
+        assert c.get('/api/v1/first/file/two.txt').status_code == 404
+        assert c.get('/api/v1/three/file').status_code == 404
+        # unprefixed resources are not available
+        assert c.get('/api/v1/file').status_code == 404
+
+        rq = c.put(
+            '/api/v1/first/file/new.txt',
+            data=json.dumps(dict(content='new')),
+            content_type='application/json')
+        assert rq.status_code == 200
+        assert 'new.txt' in c.get('/api/v1/first/file').get_json()['files']
+        assert op.exists(op.join(paths['one'], 'new.txt'))
+        assert not op.exists(op.join(paths['two'], 'new.txt'))
+
+    # invalid specs
+    res = webapp(
+        datasets=[paths['one'], 'one={}'.format(paths['two'])],
+        mode='dry-run',
+        on_failure='ignore',
+        return_type='list',
+    )
+    assert res[0]['status'] == 'error'
+    pool.close()
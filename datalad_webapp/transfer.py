@@ -0,0 +1,205 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Background retrieval of file content"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import os.path as op
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+)
+
+from datalad_webapp.content import (
+    get_annex_key,
+    has_local_content,
+)
+from datalad_webapp.metrics import metrics
+from datalad_webapp.profiling import profiled
+
+import logging
+lgr = logging.getLogger('datalad.webapp.transfer')
+
+
+class TransferJob(object):
+    """Handle for a single (possibly shared) content retrieval"""
+    def __init__(self, path, future):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.submitted = time.time()
+        self.future = future
+
+    @property
+    def status(self):
+        if self.future.running():
+            return 'running'
+        elif not self.future.done():
+            return 'pending'
+        elif self.future.exception() is not None:
+            return 'error'
+        return 'ok'
+
+    def wait(self, timeout=None):
+        """Wait for the retrieval to finish
+
+        Returns
+        -------
+        bool
+          Whether the job is done.
+        """
+        try:
+            self.future.exception(timeout=timeout)
+        except FutureTimeoutError:
+            pass
+        return self.future.done()
+
+    def result(self):
+        """Wait for the retrieval to finish, and raise on failure"""
+        return self.future.result()
+
+    def as_dict(self):
+        exc = self.future.exception() if self.future.done() else None
+        return dict(
+            id=self.id,
+            path=self.path,
+            status=self.status,
+            submitted=self.submitted,
+            message=str(exc) if exc is not None else None,
+        )
+
+
+class TransferScheduler(object):
+    """Thread pool for retrieving file content of a dataset
+
+    Concurrent requests for the same content (same annex key, or same path
+    for anything that is not a locked annexed file) share a single
+    retrieval. A limited number of finished jobs is kept, such that their
+    status can be queried.
+
+    Parameters
+    ----------
+    dataset : Dataset
+    max_workers : int
+      Maximum number of retrievals running in parallel.
+    keep : int
+      Maximum number of jobs whose status is kept after they finished.
+    batch : BatchedRepo, optional
+      If given, annexed files of the dataset itself are retrieved with its
+      'git annex get' processes, rather than with `get`.
+    """
+    def __init__(self, dataset, max_workers=4, keep=1000, batch=None):
+        self.ds = dataset
+        self.batch = batch
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._keep = keep
+        self._lock = threading.Lock()
+        # unfinished jobs by key
+        self._active = {}
+        # all known jobs by ID
+        self._jobs = OrderedDict()
+
+    def _in_annex(self, file_abspath):
+        # a locked annexed file of this dataset, not of a subdataset
+        if get_annex_key(file_abspath) is None:
+            return False
+        target = op.normpath(op.join(
+            op.dirname(file_abspath), os.readlink(file_abspath)))
+        return target.startswith(
+            op.join(self.ds.path, '.git', 'annex', 'objects') + op.sep)
+
+    def _get_batched(self, file_abspath):
+        with metrics.time_datalad_call('annex-get'):
+            res = self.batch.get(file_abspath)
+        if res is None:
+            return None
+        if not res.get('success'):
+            raise RuntimeError('could not get {}: {}'.format(
+                res.get('file'),
+                '; '.join(res.get('error-messages') or []) or 'failed'))
+        return metrics.count_transfers([dict(
+            action='get',
+            type='file',
+            status='ok',
+            path=file_abspath,
+            annexkey=res.get('key'),
+            message=res.get('note'),
+        )])
+
+    def _get(self, file_abspath):
+        if self.batch is not None and self._in_annex(file_abspath):
+            res = self._get_batched(file_abspath)
+            if res is not None:
+                return res
+            if has_local_content(file_abspath):
+                return []
+        # ensure bound dataset method
+        import datalad.distribution.get
+        with metrics.time_datalad_call('get'):
+            return metrics.count_transfers(
+                self.ds.get(file_abspath, return_type='list'))
+
+    def submit(self, file_abspath):
+        """Schedule the retrieval of a file's content
+
+        Parameters
+        ----------
+        file_abspath : str
+          Absolute path of the file in the dataset.
+
+        Returns
+        -------
+        TransferJob
+          A newly scheduled job, or an unfinished one that is already
+          retrieving the same content.
+        """
+        key = get_annex_key(file_abspath) or file_abspath
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                return job
+            job = TransferJob(
+                op.relpath(file_abspath, self.ds.path).replace(op.sep, '/'),
+                self._executor.submit(profiled(self._get), file_abspath))
+            self._active[key] = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._keep:
+                self._jobs.popitem(last=False)
+
+        def _finalize(future):
+            with self._lock:
+                if self._active.get(key) is job:
+                    del self._active[key]
+
+        job.future.add_done_callback(_finalize)
+        return job
+
+    def get_job(self, job_id):
+        """Return a job by ID, or None if there is no such job"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    @property
+    def jobs(self):
+        """List of all known jobs, in order of submission"""
+        with self._lock:
+            return list(self._jobs.values())
+
+    @property
+    def idle(self):
+        """Whether no retrieval is pending or running"""
+        with self._lock:
+            return not self._active
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,808 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Apply file modifications to a dataset"""
+
+__docformat__ = 'restructuredtext'
+
+import errno
+import gzip
+import hashlib
+import math
+import os
+import os.path as op
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+from datalad.support import json_py
+
+from datalad_webapp.metrics import metrics
+from datalad_webapp.profiling import (
+    get_request_profiles,
+    profile_into,
+)
+
+import logging
+lgr = logging.getLogger('datalad.webapp.writer')
+
+# size of the chunks uploaded content is written in
+chunk_size = 1024 * 1024
+
+# permissions of new files, as if they were created with open()
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+class FileChange(object):
+    """A single file modification
+
+    Parameters
+    ----------
+    path : str
+      Path relative to the dataset root.
+    content : str, optional
+      New file content. Ignored for deletions.
+    source : str, optional
+      Path of a file with the new content, it is moved into place. Takes
+      precedence over `content`.
+    json : {'no', 'yes', 'stream'}
+      How to interpret `content`: as-is, as a JSON document to be
+      (re-)encoded, or as a JSON array to be written as a JSON stream.
+    delete : bool
+      Flag whether to delete the file.
+    """
+    def __init__(self, path, content=None, json='no', delete=False,
+                 source=None):
+        self.path = path
+        self.content = content
+        self.source = source
+        self.json = json
+        self.delete = delete
+        # decoded JSON content, see validate()
+        self._data = None
+
+    def validate(self):
+        """Check that the change can be applied
+
+        JSON content is decoded here (once), so that invalid content is
+        rejected before anything is queued or written.
+
+        Raises
+        ------
+        ValueError
+        """
+        if self.delete or self.source is not None:
+            return
+        if not isinstance(self.content, str):
+            raise ValueError('no content for {}'.format(self.path))
+        if self.json == 'no' or self._data is not None:
+            return
+        try:
+            data = json_py.loads(self.content)
+        except ValueError as e:
+            raise ValueError(
+                'invalid JSON content for {}: {}'.format(self.path, e))
+        if self.json == 'stream' and not isinstance(data, list):
+            raise ValueError(
+                'JSON stream content for {} must be an array'.format(
+                    self.path))
+        self._data = data
+
+
+def _mktemp_next_to(file_abspath):
+    # a new file in the same directory, to be renamed into place
+    dirname, basename = op.split(file_abspath)
+    if not op.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(
+        dir=dirname, prefix='.{}.'.format(basename), suffix='.tmp')
+    os.close(fd)
+    os.chmod(tmp, 0o666 & ~_umask)
+    return tmp
+
+
+def _prepare_file(file_abspath, change):
+    # write the new content of a change to a temporary file, returns its
+    # path. Uploaded content (a source) is used as-is
+    if change.source is not None:
+        return change.source
+    change.validate()
+    tmp = _mktemp_next_to(file_abspath)
+    try:
+        if change.json == 'stream':
+            json_py.dump2stream(change._data, tmp)
+        elif change.json == 'yes':
+            json_py.dump(change._data, tmp)
+        else:
+            with open(tmp, 'w') as f:
+                f.write(change.content)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def _move_into_place(tmp, file_abspath):
+    # rename() replaces a symlink itself, an annex object it points to is
+    # never written to
+    try:
+        os.replace(tmp, file_abspath)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # an upload on another file system, copy it next to the target
+        local = _mktemp_next_to(file_abspath)
+        shutil.move(tmp, local)
+        os.replace(local, file_abspath)
+
+
+def write_file(file_abspath, content, json='no', source=None):
+    """Write content to a file, replacing any existing file
+
+    The content is written to a temporary file next to the target, and
+    renamed into place. An existing file is left untouched, if writing the
+    content fails.
+    """
+    if source is not None and not op.lexists(source) \
+            and op.lexists(file_abspath):
+        # moved into place already, by an earlier attempt
+        return
+    _move_into_place(
+        _prepare_file(
+            file_abspath, FileChange(None, content, json, source=source)),
+        file_abspath)
+
+
+def apply_changes(dataset, changes, message=None, to_git=None,
+                  fileindex=None):
+    """Apply file modifications and save them in a single commit
+
+    Parameters
+    ----------
+    dataset : Dataset
+    changes : list(FileChange)
+      Later changes of the same path supersede earlier ones.
+    message : str, optional
+      Commit message.
+    to_git : bool, optional
+      Passed on to `save`.
+    fileindex : FileIndex, optional
+      If given, it is updated with the added and removed files.
+
+    Returns
+    -------
+    list(dict)
+      Results of `save`.
+    """
+    # ensure bound dataset method
+    import datalad.core.local.save
+    # write all new content first, the working tree is not touched
+    # unless all of it could be written
+    prepared = []
+    try:
+        for change in changes:
+            file_abspath = op.join(dataset.path, change.path)
+            tmp = None
+            if change.delete:
+                pass
+            elif change.source is not None and not op.lexists(change.source):
+                if not op.lexists(file_abspath):
+                    raise ValueError(
+                        'uploaded content of {} is gone'.format(change.path))
+                # moved into place already, by an earlier attempt
+            else:
+                tmp = _prepare_file(file_abspath, change)
+            prepared.append((change, file_abspath, tmp))
+    except Exception:
+        for change, file_abspath, tmp in prepared:
+            if tmp is not None and tmp != change.source:
+                os.unlink(tmp)
+        raise
+    added = set()
+    removed = set()
+    for change, file_abspath, tmp in prepared:
+        if change.delete:
+            if op.lexists(file_abspath):
+                os.unlink(file_abspath)
+            removed.add(change.path)
+            added.discard(change.path)
+        else:
+            if tmp is not None:
+                _move_into_place(tmp, file_abspath)
+            added.add(change.path)
+            removed.discard(change.path)
+    if not added and not removed:
+        return []
+    with metrics.time_datalad_call('save'):
+        res = dataset.save(
+            [op.join(dataset.path, p) for p in sorted(added | removed)],
+            to_git=to_git,
+            message=message,
+            return_type='list',
+        )
+    if fileindex is not None:
+        fileindex.update_from_results(res, added=added, removed=removed)
+    return res
+
+
+@contextmanager
+def dataset_write_lock(dataset):
+    """Hold an exclusive lock for modifying a dataset, across processes
+
+    Within a process, `WriteScheduler` serializes all modifications. With
+    multiple server processes (e.g. gunicorn workers), their writers take
+    this lock (a file in `.git/datalad_webapp`) around each save, which
+    would otherwise collide on the git index lock. Without `fcntl`
+    (Windows), nothing is locked.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_dir = op.join(str(dataset.repo.dot_git), 'datalad_webapp')
+    if not op.exists(lock_dir):
+        os.makedirs(lock_dir)
+    with open(op.join(lock_dir, 'write.lock'), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def open_decoded_stream(stream, encoding=None):
+    """Return a file-like object that decompresses a stream while reading
+
+    Parameters
+    ----------
+    stream : file-like
+    encoding : str, optional
+      HTTP Content-Encoding of the stream: 'identity', 'gzip', or 'zstd'
+      (requires the `zstandard` package).
+
+    Raises
+    ------
+    ValueError
+      For unsupported encodings.
+    """
+    if encoding in (None, '', 'identity'):
+        return stream
+    elif encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    elif encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                "'zstandard' must be installed for zstd content encoding")
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise ValueError('unsupported content encoding: {}'.format(encoding))
+
+
+def get_upload_dir(dataset):
+    """Return the directory that holds content of unfinished uploads"""
+    upload_dir = op.join(
+        str(dataset.repo.dot_git), 'datalad_webapp', 'uploads')
+    if not op.exists(upload_dir):
+        os.makedirs(upload_dir)
+    return upload_dir
+
+
+def get_partial_upload(dataset, path):
+    """Return the file that holds a partial upload for a dataset path"""
+    return op.join(
+        get_upload_dir(dataset),
+        '{}.part'.format(hashlib.sha1(path.encode('utf-8')).hexdigest()))
+
+
+class DecodingError(Exception):
+    """Raised when compressed content of a stream cannot be decoded"""
+
+
+def _get_decoding_errors(encoding):
+    # exceptions raised by the decompressor of an encoding for bad input
+    if encoding in ('gzip', 'x-gzip'):
+        return (OSError, EOFError, zlib.error)
+    elif encoding == 'zstd':
+        import zstandard
+        return (zstandard.ZstdError, EOFError)
+    return ()
+
+
+def receive_stream(dataset, stream, encoding=None, target=None):
+    """Write a (compressed) stream to a file in chunks
+
+    Nothing of a stream that cannot be received completely is kept: a new
+    file is removed, and a given target is truncated to its former size.
+
+    Parameters
+    ----------
+    dataset : Dataset
+    stream : file-like
+    encoding : str, optional
+      See `open_decoded_stream()`.
+    target : str, optional
+      File to append to. By default a new temporary file in the upload
+      directory of the dataset is created.
+
+    Returns
+    -------
+    str
+      Path of the written file.
+
+    Raises
+    ------
+    DecodingError
+      For compressed content that cannot be decoded.
+    """
+    decoded = open_decoded_stream(stream, encoding)
+    decoding_errors = _get_decoding_errors(encoding)
+    if target is None:
+        fd, target = tempfile.mkstemp(dir=get_upload_dir(dataset))
+        os.close(fd)
+        size = None
+    else:
+        size = op.getsize(target) if op.exists(target) else 0
+    try:
+        with open(target, 'ab') as f:
+            try:
+                shutil.copyfileobj(decoded, f, chunk_size)
+            except decoding_errors as e:
+                raise DecodingError(
+                    'cannot decode {} content: {}'.format(encoding, e))
+    except BaseException:
+        if size is None:
+            os.unlink(target)
+        else:
+            with open(target, 'ab') as f:
+                f.truncate(size)
+        raise
+    return target
+
+
+class WriteQueueFull(Exception):
+    """Raised when the write queue of a dataset is full
+
+    Attributes
+    ----------
+    retry_after : int
+      Estimated number of seconds until the queue has room again.
+    """
+    def __init__(self, retry_after):
+        super(WriteQueueFull, self).__init__('too many pending writes')
+        self.retry_after = retry_after
+
+
+class _WriteRequest(object):
+    def __init__(self, changes=None, message=None, to_git=None, func=None):
+        self.changes = changes
+        self.message = message
+        self.to_git = to_git
+        self.func = func
+        self.future = Future()
+        # the writer thread profiles the work for a profiled request
+        self.profiles = get_request_profiles()
+        # outcome, set on the future once the profile is complete
+        self._outcome = None
+
+    def set_result(self, result):
+        self._outcome = (result, None)
+
+    def set_exception(self, exc):
+        self._outcome = (None, exc)
+
+    def resolve(self):
+        result, exc = self._outcome or (
+            None, RuntimeError('write request was not processed'))
+        if exc is not None:
+            self.future.set_exception(exc)
+        else:
+            self.future.set_result(result)
+
+    def can_join(self, other):
+        return self.func is None and other.func is None \
+            and self.to_git == other.to_git
+
+
+class WriteScheduler(object):
+    """Serialize all modifications of a dataset through a single writer
+
+    Concurrent saves (or removals) of a dataset collide on the git index
+    lock, hence all of them are queued and run one after another by a
+    single thread, which holds `dataset_write_lock()` meanwhile to exclude
+    the writers of other processes. File changes that queued up while a
+    save was running are applied together, in a single commit. Reads are
+    not affected.
+
+    Parameters
+    ----------
+    dataset : Dataset
+    max_queue : int
+      Maximum number of queued requests. Further requests are rejected
+      with `WriteQueueFull`.
+    max_group : int
+      Maximum number of queued requests applied in a single commit.
+    fileindex : FileIndex, optional
+      Updated after each save.
+    """
+    def __init__(self, dataset, max_queue=100, max_group=100,
+                 fileindex=None):
+        self.ds = dataset
+        self.max_group = max_group
+        self.fileindex = fileindex
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        # (moving) average duration of a write, for Retry-After estimates
+        self._duration = 1.0
+
+    def _put(self, rq, block):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='datalad-webapp-writer',
+                    daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put(rq, block=block)
+        except queue.Full:
+            raise WriteQueueFull(max(1, int(math.ceil(
+                self._duration * self._queue.qsize() / self.max_group))))
+        return rq.future
+
+    def submit_changes(self, changes, message=None, to_git=None,
+                       block=False):
+        """Queue file modifications to be saved
+
+        Parameters
+        ----------
+        changes : list(FileChange)
+        message : str, optional
+          Commit message. If the changes are saved together with those of
+          other requests, it becomes part of a combined message.
+        to_git : bool, optional
+        block : bool
+          Wait for room in the queue, rather than raising `WriteQueueFull`.
+
+        Returns
+        -------
+        Future
+          Resolves to the results of `save` for these changes.
+        """
+        return self._put(
+            _WriteRequest(changes=changes, message=message, to_git=to_git),
+            block)
+
+    def submit(self, func, block=False):
+        """Queue an arbitrary modification of the dataset
+
+        Parameters
+        ----------
+        func : callable
+          Called without arguments by the writer thread.
+        block : bool
+          Wait for room in the queue, rather than raising `WriteQueueFull`.
+
+        Returns
+        -------
+        Future
+          Resolves to the return value of `func`.
+        """
+        return self._put(_WriteRequest(func=func), block)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    @property
+    def idle(self):
+        """Whether no request is queued or being processed"""
+        return not self._queue.unfinished_tasks
+
+    def close(self):
+        """Process all queued requests, and stop the writer thread"""
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join()
+        with self._lock:
+            self._thread = None
+
+    def _run(self):
+        held = []
+        while True:
+            rq = held.pop() if held else self._queue.get()
+            if rq is None:
+                self._queue.task_done()
+                return
+            group = [rq]
+            while rq.func is None and len(group) < self.max_group:
+                try:
+                    nxt = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None or not rq.can_join(nxt):
+                    held.append(nxt)
+                    break
+                group.append(nxt)
+            t0 = time.time()
+            try:
+                with profile_into([rq.profiles for rq in group]), \
+                        dataset_write_lock(self.ds):
+                    self._process(group)
+            except Exception as e:
+                # e.g. the lock could not be taken, the writer must keep
+                # running, and no request must be left waiting
+                lgr.error('Failed to process %i write request(s): %s',
+                          len(group), e)
+                for rq in group:
+                    if rq._outcome is None:
+                        rq.set_exception(e)
+            self._duration = .8 * self._duration + .2 * (time.time() - t0)
+            for rq in group:
+                rq.resolve()
+                self._queue.task_done()
+
+    def _process(self, group):
+        if group[0].func is not None:
+            self._resolve(group[0], group[0].func)
+            return
+        if len(group) == 1:
+            self._apply(group[0])
+            return
+        messages = [rq.message for rq in group if rq.message]
+        lgr.debug('Saving %i queued write requests together', len(group))
+        try:
+            res = apply_changes(
+                self.ds,
+                [c for rq in group for c in rq.changes],
+                message='\n\n'.join(
+                    ['[DATALAD WEBAPP] Save changes of {} requests'.format(
+                        len(group))] + messages),
+                to_git=group[0].to_git,
+                fileindex=self.fileindex)
+        except Exception as e:
+            # find the culprit, do not fail everyone
+            lgr.debug('Grouped save failed (%s), saving one by one', e)
+            for rq in group:
+                self._apply(rq)
+            return
+        for rq in group:
+            paths = set(op.join(self.ds.path, c.path) for c in rq.changes)
+            rq.set_result([
+                r for r in res
+                if r.get('path') in paths or r.get('type') == 'dataset'])
+
+    def _apply(self, rq):
+        self._resolve(rq, lambda: apply_changes(
+            self.ds,
+            rq.changes,
+            message=rq.message,
+            to_git=rq.to_git,
+            fileindex=self.fileindex))
+
+    @staticmethod
+    def _resolve(rq, func):
+        try:
+            rq.set_result(func())
+        except Exception as e:
+            rq.set_exception(e)
+
+
+class WriteBehindQueue(object):
+    """Collect file modifications and save them in batches
+
+    Queued changes are applied in a single commit once `max_pending`
+    changes are queued, or `max_delay` seconds after the oldest queued
+    change was submitted, whatever comes first. Changes that could not be
+    saved stay queued, and are retried after another `max_delay` seconds,
+    up to `max_attempts` times. Then they are dropped. A failure is
+    reported by `error` until a save succeeds.
+
+    Parameters
+    ----------
+    dataset : Dataset
+    max_pending : int
+    max_delay : float
+    max_queue : int
+      Maximum number of queued changes. Further changes are rejected with
+      `WriteQueueFull`.
+    max_attempts : int
+      Number of failed saves after which changes are dropped.
+    fileindex : FileIndex, optional
+      Updated after each flush.
+    writer : WriteScheduler, optional
+      If given, queued changes are saved by it, rather than directly.
+    """
+    def __init__(self, dataset, max_pending=100, max_delay=5.0,
+                 max_queue=1000, max_attempts=3, fileindex=None,
+                 writer=None):
+        self.ds = dataset
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.fileindex = fileindex
+        self.writer = writer
+        self._cond = threading.Condition()
+        # (change, to_git, number of failed saves)
+        self._pending = []
+        self._oldest = None
+        # no flush before this time, after a failed one
+        self._retry_at = None
+        self._thread = None
+        self._closed = False
+        self._error = None
+
+    def submit(self, changes, to_git=None):
+        """Queue file modifications
+
+        Returns
+        -------
+        int
+          Number of queued changes.
+
+        Raises
+        ------
+        WriteQueueFull
+          If `max_queue` changes are queued already.
+        """
+        with self._cond:
+            if self._pending \
+                    and len(self._pending) + len(changes) > self.max_queue:
+                raise WriteQueueFull(max(1, int(math.ceil(
+                    self._next_flush() - time.time()))))
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.extend((c, to_git, 0) for c in changes)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='datalad-webapp-write-behind',
+                    daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return len(self._pending)
+
+    @property
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    @property
+    def error(self):
+        """Message of the last failed save of queued changes, or None"""
+        with self._cond:
+            return self._error
+
+    def _next_flush(self):
+        # time of the next flush, to be called with the condition held
+        if self._retry_at is not None:
+            return self._retry_at
+        if len(self._pending) >= self.max_pending:
+            return time.time()
+        return self._oldest + self.max_delay
+
+    def flush(self):
+        """Apply all queued changes now
+
+        Raises
+        ------
+        Exception
+          Whatever made a save fail. Changes that were not saved are
+          queued again, unless they failed `max_attempts` times.
+        """
+        with self._cond:
+            pending = self._pending
+            self._pending = []
+            self._oldest = None
+            self._retry_at = None
+        # changes with different to_git settings need separate saves
+        groups = []
+        for change, to_git, attempts in pending:
+            if not groups or groups[-1][0] != to_git:
+                groups.append((to_git, []))
+            groups[-1][1].append((change, attempts))
+        res = []
+        for i, (to_git, items) in enumerate(groups):
+            changes = [c for c, a in items]
+            lgr.debug('Saving %i queued file changes', len(changes))
+            message = '[DATALAD WEBAPP] Save {} file change(s)'.format(
+                len(changes))
+            try:
+                if self.writer is not None:
+                    res.extend(self.writer.submit_changes(
+                        changes, message=message, to_git=to_git,
+                        block=True).result())
+                else:
+                    with dataset_write_lock(self.ds):
+                        res.extend(apply_changes(
+                            self.ds, changes,
+                            message=message,
+                            to_git=to_git,
+                            fileindex=self.fileindex))
+            except Exception as e:
+                self._requeue(groups, i, e)
+                raise
+        with self._cond:
+            self._error = None
+        return res
+
+    def _requeue(self, groups, failed, exc):
+        # queue the changes of a failed flush again, the changes of the
+        # failed save count another attempt
+        requeue = []
+        dropped = []
+        for i, (to_git, items) in enumerate(groups[failed:], start=failed):
+            for change, attempts in items:
+                if i == failed:
+                    attempts += 1
+                if attempts >= self.max_attempts:
+                    dropped.append(change.path)
+                else:
+                    requeue.append((change, to_git, attempts))
+        error = str(exc) or exc.__class__.__name__
+        if dropped:
+            lgr.error(
+                'Dropping %i queued file change(s) after %i failed saves: '
+                '%s', len(dropped), self.max_attempts, ', '.join(dropped))
+            error = 'dropped changes of {}: {}'.format(
+                ', '.join(dropped), error)
+        with self._cond:
+            # ahead of anything queued in the meantime
+            self._pending[:0] = requeue
+            if self._pending:
+                self._oldest = time.time()
+            self._retry_at = time.time() + self.max_delay
+            self._error = error
+
+    def close(self):
+        """Stop the background thread, and save all queued changes"""
+        with self._cond:
+            self._closed = True
+            thread, self._thread = self._thread, None
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        try:
+            self.flush()
+        except Exception as e:
+            lgr.error('Failed to save %i queued file change(s): %s',
+                      self.pending, e)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                remaining = self._next_flush() - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+            try:
+                self.flush()
+            except Exception as e:
+                lgr.error(
+                    'Failed to save queued file changes, retrying in '
+                    '%.1fs: %s', self.max_delay, e)
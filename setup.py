@@ -30,8 +30,28 @@ setup(
         'datalad>=0.12.5',
         'Flask>=1.0',
         'Flask-RESTful',
+        'importlib-metadata; python_version < "3.8"',
         'pytest-cov',
     ],
+    extras_require={
+        # multi-worker WSGI servers for 'production' mode
+        'production': [
+            'waitress',
+            'gunicorn; sys_platform != "win32"',
+        ],
+        # zstd (de)compression
+        'zstd': [
+            'zstandard',
+        ],
+        # brotli response compression
+        'brotli': [
+            'brotli',
+        ],
+        # faster JSON serialization
+        'orjson': [
+            'orjson',
+        ],
+    },
     entry_points = {
         'datalad.extensions': [
             'webapp=datalad_webapp:command_suite',
@@ -44,6 +64,9 @@ setup(
             'file=datalad_webapp.resources.file:FileResource',
             'subdataset=datalad_webapp.resources.subdataset:SubdatasetResource',
             'procedure=datalad_webapp.resources.procedure:ProcedureResource',
+            'job=datalad_webapp.resources.job:JobResource',
+            'cache=datalad_webapp.resources.cache:CacheResource',
+            'object=datalad_webapp.resources.object:ObjectResource',
         ]
     },
 )